@@ -0,0 +1,34 @@
+"""add access stats and compression
+
+Revision ID: a4d6f8b0c2e1
+Revises: f1c3e5a7b9d8
+Create Date: 2026-10-18 16:05:44.318920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4d6f8b0c2e1'
+down_revision: Union[str, Sequence[str], None] = 'f1c3e5a7b9d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('files', sa.Column('last_accessed_at', sa.DateTime(), nullable=True))
+    op.add_column('files', sa.Column('access_count', sa.BigInteger(), nullable=True))
+    op.add_column('files', sa.Column('compression', sa.String(), nullable=True))
+    op.add_column('chunks', sa.Column('compression', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chunks', 'compression')
+    op.drop_column('files', 'compression')
+    op.drop_column('files', 'access_count')
+    op.drop_column('files', 'last_accessed_at')
@@ -0,0 +1,34 @@
+"""add deleted_at in files table
+
+Revision ID: b3f1c2d4e5a6
+Revises: 64ee116a4ac8
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3f1c2d4e5a6'
+down_revision: Union[str, Sequence[str], None] = '64ee116a4ac8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('files', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('files', sa.Column('purge_attempts', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_files_deleted_at'), 'files', ['deleted_at'], unique=False)
+    # Shares left behind by files deleted before shares were cleaned up on delete
+    op.execute("DELETE FROM shared_files WHERE file_id NOT IN (SELECT id FROM files)")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_files_deleted_at'), table_name='files')
+    op.drop_column('files', 'purge_attempts')
+    op.drop_column('files', 'deleted_at')
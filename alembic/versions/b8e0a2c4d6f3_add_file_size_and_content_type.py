@@ -0,0 +1,103 @@
+"""add file size, stored size and content type
+
+Revision ID: b8e0a2c4d6f3
+Revises: a4d6f8b0c2e1
+Create Date: 2026-10-18 17:12:30.846215
+
+"""
+import logging
+import mimetypes
+import os
+import zlib
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from cryptography.fernet import Fernet, InvalidToken
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8e0a2c4d6f3'
+down_revision: Union[str, Sequence[str], None] = 'a4d6f8b0c2e1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+BACKFILL_BATCH_SIZE = 500
+
+# Versioned files take the sizes of their current version
+VERSIONED_SIZES = sa.text("""
+UPDATE files SET
+    size = (
+        SELECT fv.size FROM file_versions fv
+        WHERE fv.file_id = files.id AND fv.version = files.current_version
+    ),
+    stored_size = (
+        SELECT COALESCE(SUM(c.stored_size), 0) FROM file_versions fv
+        JOIN file_version_chunks fvc ON fvc.version_id = fv.id
+        JOIN chunks c ON c.id = fvc.chunk_id
+        WHERE fv.file_id = files.id AND fv.version = files.current_version
+    )
+WHERE id IN :ids
+""").bindparams(sa.bindparam("ids", expanding=True))
+
+
+def _blob_sizes(location, compression, fernet):
+    '''Reads the blob of a file uploaded before versioning once, returns (size, stored_size)'''
+    try:
+        with open(location, 'rb') as f:
+            encrypted = f.read()
+        data = fernet.decrypt(encrypted)
+        if compression == 'zlib':
+            data = zlib.decompress(data)
+    except (OSError, InvalidToken, zlib.error):
+        logger.warning("Could not read %s, leaving its size empty", location)
+        return None, None
+    return len(data), len(encrypted)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('files', sa.Column('size', sa.BigInteger(), nullable=True))
+    op.add_column('files', sa.Column('stored_size', sa.BigInteger(), nullable=True))
+    op.add_column('files', sa.Column('content_type', sa.String(), nullable=True))
+
+    conn = op.get_bind()
+    fernet = Fernet(os.environ["FILE_ENCRYPTION_KEY"])
+    cursor = ''
+    while True:
+        rows = conn.execute(sa.text(
+            "SELECT id, location, compression, file_name FROM files WHERE id > :cursor ORDER BY id LIMIT :limit"
+        ), {"cursor": cursor, "limit": BACKFILL_BATCH_SIZE}).all()
+        if not rows:
+            break
+        cursor = rows[-1].id
+        versioned_ids = [row.id for row in rows if row.location is None]
+        if versioned_ids:
+            conn.execute(VERSIONED_SIZES, {"ids": versioned_ids})
+        blob_sizes = []
+        for row in rows:
+            if row.location is not None:
+                size, stored_size = _blob_sizes(row.location, row.compression, fernet)
+                blob_sizes.append({"id": row.id, "size": size, "stored_size": stored_size})
+        if blob_sizes:
+            conn.execute(sa.text("UPDATE files SET size = :size, stored_size = :stored_size WHERE id = :id"), blob_sizes)
+        conn.execute(sa.text("UPDATE files SET content_type = :content_type WHERE id = :id"), [
+            {"id": row.id, "content_type": mimetypes.guess_type(row.file_name)[0] or 'application/octet-stream'}
+            for row in rows
+        ])
+
+    op.create_index(
+        'ix_files_owner_user_id_content_type_created_at', 'files',
+        ['owner_user_id', 'content_type', 'created_at'], unique=False,
+        postgresql_include=['size', 'stored_size', 'deleted_at']
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_files_owner_user_id_content_type_created_at', table_name='files')
+    op.drop_column('files', 'content_type')
+    op.drop_column('files', 'stored_size')
+    op.drop_column('files', 'size')
@@ -0,0 +1,42 @@
+"""add file_changes table
+
+Revision ID: c7a9e1f3b5d2
+Revises: b3f1c2d4e5a6
+Create Date: 2026-10-18 11:40:05.127734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7a9e1f3b5d2'
+down_revision: Union[str, Sequence[str], None] = 'b3f1c2d4e5a6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('file_changes',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.String(), nullable=False),
+    sa.Column('file_id', sa.String(), nullable=False),
+    sa.Column('action', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_file_changes_user_id_id', 'file_changes', ['user_id', 'id'], unique=False)
+    op.create_index(op.f('ix_file_changes_created_at'), 'file_changes', ['created_at'], unique=False)
+    op.add_column('users', sa.Column('change_log_floor', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('users', 'change_log_floor')
+    op.drop_index(op.f('ix_file_changes_created_at'), table_name='file_changes')
+    op.drop_index('ix_file_changes_user_id_id', table_name='file_changes')
+    op.drop_table('file_changes')
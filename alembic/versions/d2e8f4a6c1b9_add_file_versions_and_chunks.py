@@ -0,0 +1,65 @@
+"""add file versions and chunks
+
+Revision ID: d2e8f4a6c1b9
+Revises: c7a9e1f3b5d2
+Create Date: 2026-10-18 13:05:48.903516
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2e8f4a6c1b9'
+down_revision: Union[str, Sequence[str], None] = 'c7a9e1f3b5d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chunks',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('stored_size', sa.BigInteger(), nullable=False),
+    sa.Column('location', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('last_seen_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_chunks_last_seen_at'), 'chunks', ['last_seen_at'], unique=False)
+    op.create_table('file_versions',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('file_id', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('checksum', sa.String(), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['file_id'], ['files.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('file_id', 'version', name='uq_file_versions_file_id_version')
+    )
+    op.create_table('file_version_chunks',
+    sa.Column('version_id', sa.String(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('chunk_id', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['chunk_id'], ['chunks.id'], ),
+    sa.ForeignKeyConstraint(['version_id'], ['file_versions.id'], ),
+    sa.PrimaryKeyConstraint('version_id', 'position')
+    )
+    op.create_index(op.f('ix_file_version_chunks_chunk_id'), 'file_version_chunks', ['chunk_id'], unique=False)
+    op.add_column('files', sa.Column('current_version', sa.Integer(), nullable=True))
+    op.alter_column('files', 'location', existing_type=sa.String(), nullable=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.alter_column('files', 'location', existing_type=sa.String(), nullable=False)
+    op.drop_column('files', 'current_version')
+    op.drop_index(op.f('ix_file_version_chunks_chunk_id'), table_name='file_version_chunks')
+    op.drop_table('file_version_chunks')
+    op.drop_table('file_versions')
+    op.drop_index(op.f('ix_chunks_last_seen_at'), table_name='chunks')
+    op.drop_table('chunks')
@@ -0,0 +1,61 @@
+"""add unique index on live file names
+
+Revision ID: d4a6c8e0f2b5
+Revises: c9f1b3d5e7a2
+Create Date: 2026-10-19 00:41:12.208463
+
+"""
+import logging
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a6c8e0f2b5'
+down_revision: Union[str, Sequence[str], None] = 'c9f1b3d5e7a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+LIVE_VERSIONED = "deleted_at IS NULL AND location IS NULL"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    conn = op.get_bind()
+    # Concurrent first uploads of a name could create two files, the newer ones get a numbered name
+    duplicates = conn.execute(sa.text(
+        f"SELECT owner_user_id, file_name FROM files WHERE {LIVE_VERSIONED} "
+        "GROUP BY owner_user_id, file_name HAVING COUNT(*) > 1"
+    )).all()
+    for owner_user_id, file_name in duplicates:
+        taken = {name for (name,) in conn.execute(sa.text(
+            f"SELECT file_name FROM files WHERE owner_user_id = :owner AND {LIVE_VERSIONED}"
+        ), {"owner": owner_user_id})}
+        ids = [file_id for (file_id,) in conn.execute(sa.text(
+            f"SELECT id FROM files WHERE owner_user_id = :owner AND file_name = :name AND {LIVE_VERSIONED} "
+            "ORDER BY created_at, id"
+        ), {"owner": owner_user_id, "name": file_name})]
+        stem, ext = os.path.splitext(file_name)
+        number = 1
+        for file_id in ids[1:]:
+            while f"{stem} ({number}){ext}" in taken:
+                number += 1
+            new_name = f"{stem} ({number}){ext}"
+            taken.add(new_name)
+            conn.execute(sa.text("UPDATE files SET file_name = :name WHERE id = :id"), {"name": new_name, "id": file_id})
+            logger.warning("Renamed duplicate file %s from %s to %s", file_id, file_name, new_name)
+
+    op.create_index(
+        'uq_files_owner_user_id_file_name_live', 'files', ['owner_user_id', 'file_name'], unique=True,
+        postgresql_where=sa.text(LIVE_VERSIONED), sqlite_where=sa.text(LIVE_VERSIONED)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_files_owner_user_id_file_name_live', table_name='files')
@@ -0,0 +1,32 @@
+"""add volume in chunks table
+
+Revision ID: e5b7d9f1a3c4
+Revises: d2e8f4a6c1b9
+Create Date: 2026-10-18 14:21:17.550392
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b7d9f1a3c4'
+down_revision: Union[str, Sequence[str], None] = 'd2e8f4a6c1b9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chunks', sa.Column('volume', sa.String(), nullable=True))
+    op.create_index(op.f('ix_chunks_volume'), 'chunks', ['volume'], unique=False)
+    # Until now every chunk was written under STORAGE_LOCATION, which is the "default" volume
+    op.execute("UPDATE chunks SET volume = 'default' WHERE volume IS NULL")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chunks_volume'), table_name='chunks')
+    op.drop_column('chunks', 'volume')
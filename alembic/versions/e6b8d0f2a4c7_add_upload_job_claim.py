@@ -0,0 +1,29 @@
+"""add claim to upload jobs
+
+Revision ID: e6b8d0f2a4c7
+Revises: d4a6c8e0f2b5
+Create Date: 2026-10-19 02:27:45.519032
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6b8d0f2a4c7'
+down_revision: Union[str, Sequence[str], None] = 'd4a6c8e0f2b5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Jobs claimed before have no claim, recovery gives them one when it takes them over
+    op.add_column('upload_jobs', sa.Column('claim', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('upload_jobs', 'claim')
@@ -0,0 +1,33 @@
+"""add unique constraint on shared_files
+
+Revision ID: f1c3e5a7b9d8
+Revises: e5b7d9f1a3c4
+Create Date: 2026-10-18 15:37:02.214587
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1c3e5a7b9d8'
+down_revision: Union[str, Sequence[str], None] = 'e5b7d9f1a3c4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Sharing the same file twice used to add a second row
+    op.execute(
+        "DELETE FROM shared_files WHERE id NOT IN "
+        "(SELECT MIN(id) FROM shared_files GROUP BY file_id, shared_user_id)"
+    )
+    op.create_unique_constraint('uq_shared_files_file_id_shared_user_id', 'shared_files', ['file_id', 'shared_user_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_shared_files_file_id_shared_user_id', 'shared_files', type_='unique')
@@ -1,34 +1,44 @@
 from dotenv import load_dotenv
 from fastapi import APIRouter, Depends, Query
 from app.database import get_db
-from app.schema import CodeRequest, VerifyCodeRequest, ShareFileRequest
+from app.schema import CodeRequest, VerifyCodeRequest, ShareFileRequest, BulkShareFileRequest
 from .crud import *
-import hashlib
 from io import BytesIO
 from fastapi import Depends, HTTPException, Query, UploadFile
 from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer
-from cryptography.fernet import Fernet
 from sqlalchemy.orm import Session
 import random
 import string
 import os
 from uuid import uuid4, UUID
 from . import models
-from .database import engine, get_db
+from .database import get_db, mark_recent_write, check_primary
 from .crud import *
 from .exceptions import *
+from .deletion import deletion_worker
+from .storage import store_file_version
+from .cache import blob_cache
+from . import ingest
+from .tiering import track_download
+from .metrics import metrics
+from . import profiling
+from fastapi import Header
+from .changes import CHANGES_PAGE_SIZE, CHANGES_MAX_WAIT_SECONDS, CHANGES_POLL_INTERVAL_SECONDS
+from fastapi.concurrency import run_in_threadpool
+from fastapi import Request
+from sqlalchemy.exc import SQLAlchemyError
+import asyncio
+import time
 from dotenv import load_dotenv
 
 
-router = APIRouter()
+router = APIRouter(route_class=profiling.route_class)
 security = HTTPBearer()
 
-load_dotenv()
-models.Base.metadata.create_all(bind=engine)
+BULK_SHARE_MAX_PAIRS = int(os.getenv("BULK_SHARE_MAX_PAIRS", "20000"))
 
-fernet = Fernet(os.environ["FILE_ENCRYPTION_KEY"])
-storage_location = os.environ["STORAGE_LOCATION"]
+load_dotenv()
 
 def generate_otp_letters():
     return ''.join(random.choices(string.ascii_letters, k=6))
@@ -39,6 +49,19 @@ def check_valid_file_uuid(uuid_string: str) -> bool:
     except ValueError:
          raise FileNotFound("invalid file id")
     
+def upload_size(in_file: UploadFile) -> int:
+    in_file.file.seek(0, os.SEEK_END)
+    file_size = in_file.file.tell()
+    in_file.file.seek(0)
+    return file_size
+
+def check_storage_limit(user: User, file_size: int, db: Session):
+    '''Free users get 5GB, counting staged uploads that are not stored yet'''
+    if not user.is_paid:
+        current_storage = (user.current_storage or 0) + get_pending_upload_bytes(user.id, db)
+        if current_storage + file_size > 5 * 1024 * 1024 * 1024:  # 5 GB
+            raise HTTPException(status_code=403, detail="Free storage limit (5GB) exceeded.")
+
 def get_user_id_from_session(session_id: str, db:Session) -> str:
     session_data = check_and_get_session_details(session_id, db).data
 
@@ -52,6 +75,36 @@ def get_user_id_from_session(session_id: str, db:Session) -> str:
 def root():
     return {"message": "Hello World"}
 
+@router.get("/ready/")
+def ready(request: Request):
+    '''200 once startup finished and while the primary database answers, for load balancers'''
+    if not getattr(request.app.state, "ready", False):
+        raise HTTPException(status_code=503, detail="Starting up")
+    try:
+        check_primary()
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ready"}
+
+@router.get("/metrics/")
+def get_metrics():
+    return metrics.snapshot()
+
+def check_admin_token(x_admin_token: str = Header(None)):
+    if not profiling.is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@router.get("/admin/profiles/", dependencies=[Depends(check_admin_token)])
+def list_profiles():
+    return {"profiles": [profile.to_dict() for profile in reversed(profiling.profiles)]}
+
+@router.get("/admin/profiles/{profile_id}", dependencies=[Depends(check_admin_token)])
+def get_profile(profile_id: str):
+    for profile in profiling.profiles:
+        if profile.id == profile_id:
+            return profile.to_dict(with_stacks=True)
+    raise HTTPException(status_code=404, detail="Profile not found")
+
 @router.post("/auth/code/request/")
 def getCode(code_request: CodeRequest, db: Session = Depends(get_db)):
     code = generate_otp_letters()
@@ -63,8 +116,11 @@ def getCode(code_request: CodeRequest, db: Session = Depends(get_db)):
 def verifyCode(verify_code_request: VerifyCodeRequest, db: Session = Depends(get_db)):
     code = verify_code_request.code
     device_id = verify_code_request.device_id
+    session_token = verify_code_and_generate_session(code, device_id, db)
+    # The first requests with the new token must not miss it on a lagging replica
+    mark_recent_write(session_token)
 
-    return {"session_token":verify_code_and_generate_session(code, device_id, db)}
+    return {"session_token": session_token}
     
 @router.post("/file/upload/")
 def uploadFile(
@@ -75,55 +131,92 @@ def uploadFile(
     session_id = token.credentials
     user_id = get_user_id_from_session(session_id, db).get("user_id")
     user = db.query(User).filter(User.id == user_id).first()
-    contents = in_file.file.read()
-    file_size = len(contents)
-    if not user.is_paid:
-        current_storage = user.current_storage or 0
-        if current_storage + file_size > 5 * 1024 * 1024 * 1024:  # 5 GB
-            raise HTTPException(status_code=403, detail="Free storage limit (5GB) exceeded.")
-    
-    file_id = uuid4()
-    os.makedirs(storage_location, exist_ok=True)
-    out_file_path = os.path.join(storage_location, f"{file_id}_{in_file.filename}")
-    hash_sha256 = hashlib.sha256()
-    hash_sha256.update(contents)
-    encrypted_contents = fernet.encrypt(contents)
-    with open(out_file_path, 'wb') as out_file:
-        out_file.write(encrypted_contents)
-
-    create_file_entry(
-        db=db,
-        file_id=file_id,
-        location=out_file_path,
-        checksum=hash_sha256.hexdigest(),
-        file_name = in_file.filename,
-        file_size=file_size,
-        user=user
-    )
-    return {"file_id": str(file_id), "checksum": hash_sha256.hexdigest()}
+    check_storage_limit(user, upload_size(in_file), db)
+
+    stored = store_file_version(db, user, in_file.filename, in_file.file, in_file.content_type)
+    return {"file_id": stored["file_id"], "version": stored["version"], "checksum": stored["checksum"]}
+
+@router.post("/file/upload/staged/", status_code=202)
+def uploadFileStaged(
+        in_file: UploadFile,
+        token: str = Depends(security),
+        db: Session = Depends(get_db)
+    ):
+    session_id = token.credentials
+    user_id = get_user_id_from_session(session_id, db).get("user_id")
+    user = db.query(User).filter(User.id == user_id).first()
+    check_storage_limit(user, upload_size(in_file), db)
+    if ingest.queue_full():
+        raise HTTPException(status_code=503, detail="Too many uploads are being processed, retry later.", headers={"Retry-After": "30"})
+
+    job = ingest.stage_upload(db, user.id, in_file.filename, in_file.content_type, in_file.file)
+    return {"job_id": job.id, "status": job.status, "status_url": f"/file/upload/status/?job_id={job.id}"}
+
+@router.get("/file/upload/status/")
+def getUploadStatus(
+        job_id: str = Query(),
+        token: str = Depends(security),
+        db: Session = Depends(get_db)
+    ):
+    session_id = token.credentials
+    check_valid_file_uuid(job_id)
+    user_id = get_user_id_from_session(session_id, db).get("user_id")
+    job = get_upload_job(user_id, job_id, db)
+    processed = job.size if job.status == "done" else (job.processed_bytes or 0)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "file_name": job.file_name,
+        "size": job.size,
+        "processed_bytes": processed,
+        "progress": round(processed / job.size, 3) if job.size else float(job.status == "done"),
+        "file_id": job.file_id,
+        "version": job.version,
+        "checksum": job.checksum,
+        "error": job.error
+    }
 
     
 @router.get("/file/download/")
 def downloadFile(
         file_id: str = Query(),
+        version: int = Query(None, ge=1),
         token: str = Depends(security),
         db: Session = Depends(get_db)
     ):
+    started = time.perf_counter()
     session_id = token.credentials     
     check_valid_file_uuid(file_id)
     
     user_id = check_and_get_session_details(session_id, db).data.get("user_id")
-    file_location, file_name = get_file_location_as_owner(owner_id= user_id, file_id=file_id, db=db)
-    with open(file_location, 'rb') as f:
-        encrypted_data = f.read()
-    decrypted_data = fernet.decrypt(encrypted_data)
+    file = get_file_as_owner(owner_id=user_id, file_id=file_id, db=db)
+    if file.location is not None:
+        # Uploaded before versioning, stored as a single blob
+        if version not in (None, 1):
+            raise FileNotFound(details="Version not found")
+        chunks = [(file.location, file.compression)]
+    else:
+        chunks = get_version_chunks(file, version, db)
+    # file.size is the current version's, older versions are read past the download cache
+    size = file.size if version in (None, file.current_version) else None
 
     return StreamingResponse(
-        BytesIO(decrypted_data),
+        track_download(file.id, chunks, started, size),
         media_type="application/octet-stream",
-        headers={"Content-Disposition": f"attachment; filename={file_name}"}
+        headers={"Content-Disposition": f"attachment; filename={file.file_name}"}
     )
 
+@router.get("/file/versions/")
+def listFileVersions(
+        file_id: str = Query(),
+        token: str = Depends(security),
+        db: Session = Depends(get_db)
+    ):
+    session_id = token.credentials
+    check_valid_file_uuid(file_id)
+    user_id = get_user_id_from_session(session_id, db).get("user_id")
+    return {"versions": list_file_versions(owner_id=user_id, file_id=file_id, db=db)}
+
 @router.post("/file/share/", tags=["files"])
 def share_file(
     request: ShareFileRequest, 
@@ -137,6 +230,50 @@ def share_file(
     add_share_file(request.file_id, request.email, db)
     return {"status" : "ok"}
 
+@router.post("/file/share/bulk/", tags=["files"])
+def share_files_bulk(
+    request: BulkShareFileRequest,
+    token: str = Depends(security),
+    db: Session = Depends(get_db)
+    ):
+    session_id = token.credentials
+    user_id = get_user_id_from_session(session_id, db).get("user_id")
+    if len(set(request.file_ids)) * len(set(request.emails)) > BULK_SHARE_MAX_PAIRS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_SHARE_MAX_PAIRS} file/email pairs per request.")
+    return {"results": add_share_files_bulk(user_id, request.file_ids, request.emails, db)}
+
+@router.post("/file/unshare/", tags=["files"])
+def unshare_file(
+    request: ShareFileRequest,
+    token: str = Depends(security),
+    db: Session = Depends(get_db)
+    ):
+    session_id = token.credentials
+    user_id = get_user_id_from_session(session_id, db).get("user_id")
+    if not is_owner(file_id=request.file_id, user_id=user_id, db=db):
+        raise FilePermissionError(details= "File not accessible")
+    remove_share_file(request.file_id, request.email, db)
+    return {"status" : "ok"}
+
+@router.get("/file/changes/")
+async def list_changes(
+        cursor: int = Query(0, ge=0),
+        wait: int = Query(0, ge=0, le=CHANGES_MAX_WAIT_SECONDS),
+        token: str = Depends(security),
+        db: Session = Depends(get_db)
+    ):
+    session_id = token.credentials
+    user_id = (await run_in_threadpool(get_user_id_from_session, session_id, db)).get("user_id")
+    deadline = time.monotonic() + wait
+    while True:
+        result = await run_in_threadpool(get_changes_since, user_id, cursor, db, CHANGES_PAGE_SIZE)
+        remaining = deadline - time.monotonic()
+        if result["changes"] or result["reset"] or result["has_more"] or remaining <= 0:
+            return result
+        # Give the connection back to the pool while waiting
+        await run_in_threadpool(db.close)
+        await asyncio.sleep(min(CHANGES_POLL_INTERVAL_SECONDS, remaining))
+
 @router.get("/file/list/")
 def listFiles(
         token: str = Depends(security),
@@ -161,9 +298,11 @@ def delete_file(
     check_valid_file_uuid(file_id)
     session_data = check_and_get_session_details(session_id, db).data
     user_id = session_data.get("user_id")
-    file_path = delete_file_from_storage(file_id, user_id, db)
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    tombstone_file(file_id, user_id, db)
+    if blob_cache.enabled:
+        # Chunks shared with other files are dropped too, they are read again on their next download
+        blob_cache.invalidate(get_file_blob_locations(file_id, db))
+    deletion_worker.wake()
     return {
         "status": "ok"
     }
@@ -193,6 +332,15 @@ def get_user_storage(
         "is_paid" : user.is_paid
     }
 
+@router.get("/user/storage/breakdown/")
+def get_user_storage_breakdown(
+        token: str = Depends(security),
+        db = Depends(get_db)
+    ):
+    session_id = token.credentials
+    user_id = get_user_id_from_session(session_id, db).get("user_id")
+    return get_storage_breakdown(user_id, db)
+
 @router.post("/user/upgrade/")
 def upgrade_user(
         token: str = Depends(security),
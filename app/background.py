@@ -0,0 +1,74 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    '''Runs a job in a daemon thread every `interval` seconds until stopped'''
+
+    def __init__(self, name: str, job, interval: float):
+        self.name = name
+        self.job = job
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        '''Runs the job as soon as possible instead of waiting for the interval'''
+        self._wakeup.set()
+
+    def stop(self, timeout: float = 5):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.job()
+            except Exception:
+                logger.exception("Background job %s failed", self.name)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+
+# Jobs on shared state run in the leader process only, see app.leader. Jobs on state kept in
+# memory (download counts, replica health) run in every process.
+workers = []
+process_workers = []
+
+
+def register_worker(worker: PeriodicWorker, every_process: bool = False) -> PeriodicWorker:
+    (process_workers if every_process else workers).append(worker)
+    return worker
+
+
+def start_workers():
+    for worker in workers:
+        worker.start()
+
+
+def stop_workers():
+    for worker in workers:
+        worker.stop()
+
+
+def start_process_workers():
+    for worker in process_workers:
+        worker.start()
+
+
+def stop_process_workers():
+    for worker in process_workers:
+        worker.stop()
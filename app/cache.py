@@ -0,0 +1,101 @@
+'''Decrypted blob contents shared between downloads.
+
+Concurrent reads of the same blob are coalesced: one thread reads and decrypts it, the others
+wait for its result. With DOWNLOAD_CACHE_BYTES set, the blobs of files up to
+DOWNLOAD_CACHE_MAX_FILE_BYTES are also kept in memory, least recently used first out. Larger
+files are read past the cache so one big download does not evict the blobs of many small,
+frequently downloaded ones. Blobs are keyed by location, which
+never gets different content, and are dropped when they are deleted or moved away.
+'''
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from app.metrics import metrics
+
+load_dotenv()
+
+DOWNLOAD_CACHE_BYTES = int(os.getenv("DOWNLOAD_CACHE_BYTES", "0"))
+DOWNLOAD_CACHE_MAX_FILE_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_FILE_BYTES", str(8 * 1024 * 1024)))
+
+
+class BlobCache:
+    def __init__(self, max_bytes: int, max_file_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._in_flight = {}
+        # Bumped by every invalidation, loads that overlap one are not cached
+        self._generation = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def admits(self, file_size: int) -> bool:
+        '''Whether the blobs of a file of this size (None when unknown) are worth keeping'''
+        return self.enabled and file_size is not None and file_size <= self.max_file_bytes
+
+    def get(self, key: str, load, cacheable: bool = True):
+        '''Returns the cached value, or load()'s result shared with concurrent callers.
+        The result is only kept when cacheable, see admits'''
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                metrics.inc("download_cache_hits")
+                return data
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = Future()
+                generation = self._generation
+        if not leader:
+            metrics.inc("download_cache_coalesced")
+            return call.result()
+
+        metrics.inc("download_cache_misses")
+        try:
+            data = load()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            call.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if cacheable and generation == self._generation:
+                self._put(key, data)
+        call.set_result(data)
+        return data
+
+    def _put(self, key: str, data: bytes):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            metrics.inc("download_cache_evictions")
+
+    def invalidate(self, keys: list):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                data = self._entries.pop(key, None)
+                if data is not None:
+                    self._bytes -= len(data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"bytes": self._bytes, "entries": len(self._entries)}
+
+
+blob_cache = BlobCache(DOWNLOAD_CACHE_BYTES, DOWNLOAD_CACHE_MAX_FILE_BYTES)
+
+metrics.register_gauge("download_cache_bytes", lambda: [({}, blob_cache.stats()["bytes"])])
+metrics.register_gauge("download_cache_entries", lambda: [({}, blob_cache.stats()["entries"])])
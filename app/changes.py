@@ -0,0 +1,23 @@
+'''Background compaction of the per-user change log used by the change feed'''
+import os
+from datetime import datetime, timedelta, UTC
+from app.background import PeriodicWorker
+from app.crud import compact_change_log
+from app.database import SessionLocal
+
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "500"))
+CHANGES_MAX_WAIT_SECONDS = int(os.getenv("CHANGES_MAX_WAIT_SECONDS", "30"))
+CHANGES_POLL_INTERVAL_SECONDS = float(os.getenv("CHANGES_POLL_INTERVAL_SECONDS", "1"))
+CHANGE_LOG_RETENTION_SECONDS = int(os.getenv("CHANGE_LOG_RETENTION_SECONDS", str(7 * 24 * 60 * 60)))
+CHANGE_LOG_COMPACT_INTERVAL_SECONDS = int(os.getenv("CHANGE_LOG_COMPACT_INTERVAL_SECONDS", str(60 * 60)))
+
+
+def run_compaction_job():
+    db = SessionLocal()
+    try:
+        compact_change_log(datetime.now(UTC) - timedelta(seconds=CHANGE_LOG_RETENTION_SECONDS), db)
+    finally:
+        db.close()
+
+
+compaction_worker = PeriodicWorker("change-log-compaction", run_compaction_job, CHANGE_LOG_COMPACT_INTERVAL_SECONDS)
@@ -1,9 +1,12 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, delete, update, case, func, exists, bindparam, text
+from sqlalchemy.dialects import postgresql, sqlite
 from datetime import datetime, timedelta, UTC
 from uuid import uuid4
-from app.models import User, AuthCode, SessionToken, File, SharedFile
+from app.models import User, AuthCode, SessionToken, File, SharedFile, FileChange, FileVersion, FileVersionChunk, Chunk, UploadJob
 from .exceptions import *
+import hashlib
 import os
 import secrets
 
@@ -89,54 +92,404 @@ def check_and_get_session_details(session_id: str, db: Session):
         raise InvalidSession("Invalid or expired session")
     return session
 
-def create_file_entry(location:str, file_name:str, file_id: str, db:Session, checksum:str, file_size: str, user: User):
-    '''Creatse new file entry and updates the storage for the current user '''
-    new_file = File(
-        id=str(file_id),
-        location=location,
-        owner_user_id=user.id,
-        checksum=checksum,
-        file_name=file_name,
+def insert_ignoring_duplicates(model, rows: list, db: Session, returning: tuple = ()):
+    '''Bulk inserts the rows in one statement, skipping the ones whose key already exists.
+    Returns the `returning` columns of the rows actually inserted'''
+    if not rows:
+        return []
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(model).on_conflict_do_nothing()
+    if not returning:
+        db.execute(statement, rows)
+        return []
+    return db.execute(statement.returning(*returning), rows).all()
+
+def touch_chunks(chunk_ids: list, db: Session) -> dict:
+    '''Marks the chunks as just seen so garbage collection keeps them, and returns the stored size
+    of the ones that exist'''
+    db.execute(update(Chunk).where(Chunk.id.in_(chunk_ids)).values(last_seen_at=datetime.now(UTC)))
+    existing = dict(db.query(Chunk.id, Chunk.stored_size).filter(Chunk.id.in_(chunk_ids)).all())
+    db.commit()
+    return existing
+
+# Feed cursors are change ids, so a user's changes must become visible in id order: a change
+# committed after the cursor moved past its id would never be returned. Transactions recording
+# changes hold a lock per user until they commit, so the next one only draws its ids afterwards.
+# SQLite runs one writing transaction at a time already.
+CHANGE_LOG_LOCK_SPACE = 1
+
+def _advisory_key(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode()).digest()[:4], "big", signed=True)
+
+def record_changes(changes: list, db: Session):
+    '''Adds the {"user_id", "file_id", "action"} entries to the change log. Call it once per
+    transaction, as late as possible: the users' change log locks are held until commit'''
+    if not changes:
+        return
+    # Rows locked by pending writes are locked before the users are, like everywhere else
+    db.flush()
+    if db.get_bind().dialect.name == "postgresql":
+        # In one order everywhere, so transactions locking several users cannot deadlock
+        for key in sorted({_advisory_key(change["user_id"]) for change in changes}):
+            db.execute(text("SELECT pg_advisory_xact_lock(:space, :key)"), {"space": CHANGE_LOG_LOCK_SPACE, "key": key})
+    db.execute(FileChange.__table__.insert(), changes)
+
+def create_file_entry(db: Session, user: User, file_name: str, checksum: str, file_size: int, stored_size: int, content_type: str, chunk_ids: list, new_chunks: list, keep_versions: int, upload_job_id: str = None, upload_claim: str = None, volume_of=None):
+    '''Adds a version to the user's file with this name (creating the file on first upload),
+    drops versions beyond keep_versions and updates the storage for the current user.
+    A file with this name uploaded before versioning becomes version 1 (volume_of gives the
+    volume name of its blob). The staged upload job, if any, is completed in the same transaction,
+    which is rolled back with UploadJobTakenOver when upload_claim no longer holds the job'''
+    insert_ignoring_duplicates(Chunk, new_chunks, db)
+
+    file = get_live_file_for_update(user.id, file_name, db)
+    if not file:
+        file = get_live_legacy_file_for_update(user.id, file_name, db)
+        if file:
+            convert_legacy_file(file, volume_of(file.location), db)
+    if not file:
+        file = File(id=str(uuid4()), owner_user_id=user.id, file_name=file_name, checksum=checksum)
+        try:
+            with db.begin_nested():
+                db.add(file)
+        except IntegrityError:
+            # A concurrent first upload of the same name created the file, this becomes a version of it
+            file = get_live_file_for_update(user.id, file_name, db)
+    file.current_version = (file.current_version or 0) + 1
+    file.checksum = checksum
+    file.size = file_size
+    file.stored_size = stored_size
+    file.content_type = content_type
+
+    version = FileVersion(file_id=file.id, version=file.current_version, checksum=checksum, size=file_size)
+    db.add(version)
+    db.flush()
+    if chunk_ids:
+        db.execute(FileVersionChunk.__table__.insert(), [
+            {"version_id": version.id, "position": position, "chunk_id": chunk_id}
+            for position, chunk_id in enumerate(chunk_ids)
+        ])
+
+    freed = prune_file_versions(file.id, file.current_version - keep_versions, db)
+    user.current_storage = max(0, (user.current_storage or 0) + file_size - freed)
+    # Users the file is shared with see the new version too
+    recipients = db.query(SharedFile.shared_user_id).filter(SharedFile.file_id == file.id).all()
+    if upload_job_id:
+        completed = db.query(UploadJob).filter(
+            UploadJob.id == upload_job_id,
+            UploadJob.status == "processing",
+            UploadJob.claim == upload_claim
+        ).update({
+            "status": "done",
+            "processed_bytes": file_size,
+            "file_id": file.id,
+            "version": version.version,
+            "checksum": checksum,
+            "updated_at": datetime.now(UTC)
+        }, synchronize_session=False)
+        if not completed:
+            # Recovery took the job over, the new claimant stores the upload
+            db.rollback()
+            raise UploadJobTakenOver(details="The upload job was claimed again")
+    record_changes([
+        {"user_id": user_id, "file_id": file.id, "action": "upload"}
+        for user_id in [user.id] + [recipient_id for (recipient_id,) in recipients]
+    ], db)
+    db.commit()
+    return file.id, version.version
+
+def get_live_file_for_update(user_id: str, file_name: str, db: Session):
+    '''Locks the user's versioned file with this name, unique among live files (see models.File)'''
+    return db.query(File).filter(
+        File.owner_user_id == user_id,
+        File.file_name == file_name,
+        File.location.is_(None),
+        File.deleted_at.is_(None)
+    ).with_for_update().first()
+
+def get_live_legacy_file_for_update(user_id: str, file_name: str, db: Session):
+    '''Locks the user's latest file with this name uploaded before versioning'''
+    return db.query(File).filter(
+        File.owner_user_id == user_id,
+        File.file_name == file_name,
+        File.location.isnot(None),
+        File.deleted_at.is_(None)
+    ).order_by(File.created_at.desc()).with_for_update().first()
+
+def convert_legacy_file(file: File, volume: str, db: Session):
+    '''Makes the file's blob the only chunk of its version 1, so uploads can add versions to it.
+    The chunk id is not derived from the content, so later uploads never reuse it'''
+    chunk = Chunk(
+        id=f"legacy-{file.id}",
+        size=file.size or 0,
+        stored_size=file.stored_size or file.size or 0,
+        location=file.location,
+        volume=volume,
+        compression=file.compression
     )
-    user.current_storage = (user.current_storage or 0) + file_size
-    db.add(new_file)
+    version = FileVersion(file_id=file.id, version=1, checksum=file.checksum, size=file.size or 0)
+    db.add_all([chunk, version])
+    db.flush()
+    db.execute(FileVersionChunk.__table__.insert(), [{"version_id": version.id, "position": 0, "chunk_id": chunk.id}])
+    file.location = None
+    file.compression = None
+    file.current_version = 1
+
+def prune_file_versions(file_id: str, up_to_version: int, db: Session) -> int:
+    '''Deletes the versions of the file up to and including up_to_version, returns their total size.
+    Their chunks are removed by garbage collection once nothing references them'''
+    if up_to_version < 1:
+        return 0
+    versions = db.query(FileVersion.id, FileVersion.size).filter(
+        FileVersion.file_id == file_id,
+        FileVersion.version <= up_to_version
+    ).all()
+    if not versions:
+        return 0
+    version_ids = [version_id for version_id, _ in versions]
+    db.query(FileVersionChunk).filter(FileVersionChunk.version_id.in_(version_ids)).delete(synchronize_session=False)
+    db.query(FileVersion).filter(FileVersion.id.in_(version_ids)).delete(synchronize_session=False)
+    return sum(size for _, size in versions)
+
+def relocate_blob(model, row_id: str, old_location: str, new_location: str, db: Session, **values) -> bool:
+    '''Points a files or chunks row at the blob's new location, unless the row changed since it was read'''
+    updated = db.query(model).filter(
+        model.id == row_id,
+        model.location == old_location
+    ).update({"location": new_location, **values}, synchronize_session=False)
     db.commit()
+    return updated == 1
 
-def get_file_location_as_owner(owner_id:str, file_id:str, db:Session):
-    '''Retrieves file location'''
+def get_file_as_owner(owner_id: str, file_id: str, db: Session):
+    '''Retrieves the file if the user owns it'''
     file = db.query(File).filter(
         File.id == file_id,
-        File.owner_user_id ==owner_id
+        File.owner_user_id == owner_id,
+        File.deleted_at.is_(None)
     ).first()
     if not file:
         raise FileNotFound(details="File not found")
-    return file.location, file.file_name
+    return file
+
+def get_version_chunks(file: File, version: int, db: Session):
+    '''Retrieves the (location, compression) of the chunks of a version (the latest by default), in order'''
+    file_version = db.query(FileVersion).filter(
+        FileVersion.file_id == file.id,
+        FileVersion.version == (version or file.current_version)
+    ).first()
+    if not file_version:
+        raise FileNotFound(details="Version not found")
+    chunks = (
+        db.query(Chunk.location, Chunk.compression)
+        .join(FileVersionChunk, FileVersionChunk.chunk_id == Chunk.id)
+        .filter(FileVersionChunk.version_id == file_version.id)
+        .order_by(FileVersionChunk.position)
+        .all()
+    )
+    return [(location, compression) for location, compression in chunks]
+
+def record_file_accesses(accesses: dict, db: Session):
+    '''Adds download counts and last access times, given as {file_id: (count, accessed_at)}'''
+    if not accesses:
+        return
+    files = File.__table__
+    db.execute(
+        update(files)
+        .where(files.c.id == bindparam("file_id"))
+        .values(
+            access_count=func.coalesce(files.c.access_count, 0) + bindparam("count"),
+            last_accessed_at=bindparam("accessed_at")
+        ),
+        [
+            {"file_id": file_id, "count": count, "accessed_at": accessed_at}
+            for file_id, (count, accessed_at) in accesses.items()
+        ]
+    )
+    db.commit()
+
+def _last_access():
+    return func.coalesce(File.last_accessed_at, File.created_at)
+
+def get_cold_chunks(older_than: datetime, cold_volume: str, limit: int, db: Session):
+    '''Retrieves chunks outside the cold volume that no file accessed since older_than references'''
+    recently_used = (
+        select(FileVersionChunk.chunk_id)
+        .join(FileVersion, FileVersion.id == FileVersionChunk.version_id)
+        .join(File, File.id == FileVersion.file_id)
+        .where(FileVersionChunk.chunk_id == Chunk.id, _last_access() >= older_than)
+        .correlate(Chunk)
+    )
+    return (
+        db.query(Chunk.id, Chunk.location, Chunk.compression)
+        .filter(Chunk.volume != cold_volume, Chunk.last_seen_at < older_than, ~recently_used.exists())
+        .limit(limit)
+        .all()
+    )
+
+def get_cold_blob_files(older_than: datetime, cold_prefix: str, limit: int, db: Session):
+    '''Retrieves files uploaded before versioning whose blob is not on the cold volume yet
+    and that were not accessed since older_than'''
+    return (
+        db.query(File.id, File.location, File.compression)
+        .filter(
+            File.location.isnot(None),
+            ~File.location.startswith(cold_prefix, autoescape=True),
+            File.deleted_at.is_(None),
+            _last_access() < older_than
+        )
+        .limit(limit)
+        .all()
+    )
+
+def get_file_chunks_on_volume(file_id: str, volume: str, db: Session):
+    '''Retrieves the distinct chunks of any retained version of the file stored on the volume'''
+    return (
+        db.query(Chunk.id, Chunk.location, Chunk.compression)
+        .join(FileVersionChunk, FileVersionChunk.chunk_id == Chunk.id)
+        .join(FileVersion, FileVersion.id == FileVersionChunk.version_id)
+        .filter(FileVersion.file_id == file_id, Chunk.volume == volume)
+        .distinct()
+        .all()
+    )
+
+def list_file_versions(owner_id: str, file_id: str, db: Session):
+    '''Retrieves the retained versions of the file, newest first'''
+    file = get_file_as_owner(owner_id, file_id, db)
+    versions = db.query(FileVersion).filter(FileVersion.file_id == file.id).order_by(FileVersion.version.desc()).all()
+    return [
+        {
+            "version": version.version,
+            "size": version.size,
+            "checksum": version.checksum,
+            "created_at": version.created_at.isoformat()
+        }
+        for version in versions
+    ]
+
+def delete_unreferenced_chunks(older_than: datetime, limit: int, db: Session):
+    '''Deletes up to limit chunk rows no version uses and no upload touched since older_than.
+    Returns the locations of the deleted chunks so their blobs can be removed'''
+    unreferenced = ~exists().where(FileVersionChunk.chunk_id == Chunk.id)
+    candidates = db.query(Chunk.id, Chunk.location).filter(unreferenced, Chunk.last_seen_at < older_than).limit(limit).all()
+    if not candidates:
+        return []
+    chunk_ids = [chunk_id for chunk_id, _ in candidates]
+    # Check again in the delete itself in case an upload picked a chunk up in the meantime
+    db.query(Chunk).filter(
+        Chunk.id.in_(chunk_ids),
+        unreferenced,
+        Chunk.last_seen_at < older_than
+    ).delete(synchronize_session=False)
+    kept = set(db.query(Chunk.id, Chunk.location).filter(Chunk.id.in_(chunk_ids)))
+    db.commit()
+    return [location for chunk_id, location in candidates if (chunk_id, location) not in kept]
 
 def add_share_file(file_id, email, db):
     '''Adds the file_id and user_id of the user to whom the file got shared in the SharedFiles table'''
     user = get_user(email, db)
     if not user:
         raise UserNotFound(details="User not found")
+    already_shared = db.query(SharedFile).filter(
+        SharedFile.file_id == file_id,
+        SharedFile.shared_user_id == user.id
+    ).first()
+    if already_shared:
+        return
     shared = SharedFile(file_id = file_id, shared_user_id = user.id)
     db.add(shared)
+    record_changes([{"user_id": user.id, "file_id": file_id, "action": "share"}], db)
+    db.commit()
+
+def add_share_files_bulk(owner_id: str, file_ids: list, emails: list, db: Session):
+    '''Shares each of the owner's files with each user using a fixed number of queries,
+    returns the outcome for every (file_id, email) pair'''
+    file_ids = list(dict.fromkeys(file_ids))
+    emails = list(dict.fromkeys(emails))
+    user_ids = dict(db.query(User.email, User.id).filter(User.email.in_(emails)).all())
+    owned = {
+        file_id for (file_id,) in db.query(File.id).filter(
+            File.id.in_(file_ids),
+            File.owner_user_id == owner_id,
+            File.deleted_at.is_(None)
+        )
+    }
+    existing = set()
+    if owned and user_ids:
+        existing = set(
+            db.query(SharedFile.file_id, SharedFile.shared_user_id).filter(
+                SharedFile.file_id.in_(owned),
+                SharedFile.shared_user_id.in_(user_ids.values())
+            ).all()
+        )
+
+    new_shares = [
+        {"file_id": file_id, "shared_user_id": user_ids[email]}
+        for file_id in file_ids if file_id in owned
+        for email in emails if email in user_ids and (file_id, user_ids[email]) not in existing
+    ]
+    # Shares a concurrent request added in the meantime are skipped by the insert
+    inserted = set()
+    if new_shares:
+        inserted = set(insert_ignoring_duplicates(
+            SharedFile, new_shares, db, returning=(SharedFile.file_id, SharedFile.shared_user_id)
+        ))
+        record_changes([
+            {"user_id": user_id, "file_id": file_id, "action": "share"}
+            for file_id, user_id in inserted
+        ], db)
+        db.commit()
+
+    results = []
+    for file_id in file_ids:
+        for email in emails:
+            user_id = user_ids.get(email)
+            if file_id not in owned:
+                status = "not_owner"
+            elif user_id is None:
+                status = "user_not_found"
+            elif (file_id, user_id) in inserted:
+                status = "shared"
+            else:
+                status = "already_shared"
+            results.append({"file_id": file_id, "email": email, "status": status})
+    return results
+
+def remove_share_file(file_id, email, db):
+    '''Removes the share of the file with the user'''
+    user = get_user(email, db)
+    if not user:
+        raise UserNotFound(details="User not found")
+    removed = db.query(SharedFile).filter(
+        SharedFile.file_id == file_id,
+        SharedFile.shared_user_id == user.id
+    ).delete(synchronize_session=False)
+    if removed:
+        record_changes([{"user_id": user.id, "file_id": file_id, "action": "unshare"}], db)
     db.commit()
 
 def is_owner(file_id, user_id, db) -> bool:
     '''Checks is the user owns the file'''
-    file = db.query(File).filter(File.owner_user_id == user_id, File.id == file_id).first()
+    file = db.query(File).filter(
+        File.owner_user_id == user_id,
+        File.id == file_id,
+        File.deleted_at.is_(None)
+    ).first()
     if not file:
         return False
     return True
 
 def list_owned_files(owner_id: str, db: Session):
     '''Retrieves the list of the files the user uploaded'''
-    files = db.query(File).filter(File.owner_user_id ==owner_id).all()
+    files = db.query(File).filter(File.owner_user_id ==owner_id, File.deleted_at.is_(None)).all()
     files_list = []
     for file in files:  
         file_info = {
             "id": str(file.id),
             "created_at": file.created_at.isoformat(),
-            "file_name": file.file_name
+            "file_name": file.file_name,
+            "version": file.current_version or 1,
+            "size": file.size,
+            "content_type": file.content_type
         }
         files_list.append(file_info)
 
@@ -144,36 +497,307 @@ def list_owned_files(owner_id: str, db: Session):
 
 def list_shared_files(shared_user_id: str, db: Session):
     '''Retrieves the files that got shared for the user'''
-    shared_entries = db.query(SharedFile).filter(SharedFile.shared_user_id == shared_user_id).all()
+    shared_entries = (
+        db.query(SharedFile, File)
+        .join(File, File.id == SharedFile.file_id)
+        .filter(SharedFile.shared_user_id == shared_user_id, File.deleted_at.is_(None))
+        .all()
+    )
     shared_files = []
-    for entry in shared_entries:
-        file = db.query(File).filter(File.id == entry.file_id).first()
-        if file:
-            owner = db.query(User).filter(User.id == file.owner_user_id).first()
-            shared_files.append({
-                "id": file.id,
-                "created_at": file.created_at.isoformat(),
-                "file_name": file.file_name,
-                "owner_user_id" : owner.id,
-                "shared_at": entry.shared_at.isoformat()
-            })
+    for entry, file in shared_entries:
+        shared_files.append({
+            "id": file.id,
+            "created_at": file.created_at.isoformat(),
+            "file_name": file.file_name,
+            "owner_user_id" : file.owner_user_id,
+            "shared_at": entry.shared_at.isoformat(),
+            "size": file.size,
+            "content_type": file.content_type
+        })
     return shared_files
 
+def _upload_month(column, db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        return func.to_char(func.date_trunc("month", column), "YYYY-MM")
+    return func.strftime("%Y-%m", column)
+
+def get_storage_breakdown(user_id: str, db: Session):
+    '''Sums the sizes of the user's files by content type and by upload month.
+
+    The database aggregates by (type, month) in one pass over the owner's index entries, only
+    the few resulting groups are added up here'''
+    content_type = func.coalesce(File.content_type, "application/octet-stream")
+    month = _upload_month(File.created_at, db)
+    groups = (
+        db.query(
+            content_type,
+            month,
+            func.count(File.id),
+            func.coalesce(func.sum(File.size), 0),
+            func.coalesce(func.sum(File.stored_size), 0)
+        )
+        .filter(File.owner_user_id == user_id, File.deleted_at.is_(None))
+        .group_by(content_type, month)
+        .all()
+    )
+    by_type = {}
+    by_month = {}
+    total = {"files": 0, "size": 0, "stored_size": 0}
+    for group_type, group_month, files, size, stored_size in groups:
+        for sums in (
+            by_type.setdefault(group_type, {"content_type": group_type, "files": 0, "size": 0, "stored_size": 0}),
+            by_month.setdefault(group_month, {"month": group_month, "files": 0, "size": 0, "stored_size": 0}),
+            total
+        ):
+            sums["files"] += files
+            sums["size"] += size
+            sums["stored_size"] += stored_size
+    return {
+        "total": total,
+        "by_type": [by_type[key] for key in sorted(by_type)],
+        "by_month": [by_month[key] for key in sorted(by_month)]
+    }
+
+def get_pending_upload_bytes(user_id: str, db: Session) -> int:
+    '''Total size of the user's staged uploads that are not stored yet'''
+    return db.query(func.coalesce(func.sum(UploadJob.size), 0)).filter(
+        UploadJob.user_id == user_id,
+        UploadJob.status.in_(("staged", "processing"))
+    ).scalar()
+
+def create_upload_job(job_id: str, user_id: str, file_name: str, content_type: str, staged_path: str, size: int, db: Session):
+    job = UploadJob(id=job_id, user_id=user_id, file_name=file_name, content_type=content_type, staged_path=staged_path, size=size)
+    db.add(job)
+    db.commit()
+    return job
+
+def get_upload_job(user_id: str, job_id: str, db: Session):
+    '''Retrieves the user's upload job'''
+    job = db.query(UploadJob).filter(UploadJob.id == job_id, UploadJob.user_id == user_id).first()
+    if not job:
+        raise FileNotFound(details="Upload job not found")
+    return job
+
+def claim_upload_job(job_id: str, stale_before: datetime, db: Session):
+    '''Marks a staged job, or one whose processing stalled before stale_before, as processing.
+    Returns None when someone else has it or it is finished. The job's claim tells this claim
+    apart from earlier ones, whose workers may still be running'''
+    claimed = db.query(UploadJob).filter(
+        UploadJob.id == job_id,
+        (UploadJob.status == "staged") | ((UploadJob.status == "processing") & (UploadJob.updated_at < stale_before))
+    ).update(
+        {"status": "processing", "claim": uuid4().hex, "processed_bytes": 0, "updated_at": datetime.now(UTC)},
+        synchronize_session=False
+    )
+    db.commit()
+    if not claimed:
+        return None
+    return db.query(UploadJob).filter(UploadJob.id == job_id).first()
+
+def update_upload_job_progress(job_id: str, claim: str, processed_bytes: int, db: Session):
+    db.query(UploadJob).filter(UploadJob.id == job_id, UploadJob.status == "processing", UploadJob.claim == claim).update(
+        {"processed_bytes": processed_bytes, "updated_at": datetime.now(UTC)}, synchronize_session=False
+    )
+    db.commit()
+
+def fail_upload_job(job_id: str, error: str, db: Session, claim: str = None) -> bool:
+    '''Marks the job as failed unless it finished in the meantime or, given a claim, was claimed
+    again. Returns whether it did'''
+    query = db.query(UploadJob).filter(UploadJob.id == job_id, UploadJob.status.in_(("staged", "processing")))
+    if claim is not None:
+        query = query.filter(UploadJob.claim == claim)
+    failed = query.update({"status": "failed", "error": error, "updated_at": datetime.now(UTC)}, synchronize_session=False)
+    db.commit()
+    return failed == 1
+
+def get_recoverable_upload_jobs(stale_before: datetime, db: Session):
+    '''Retrieves staged jobs and jobs whose processing stalled, e.g. because the process died'''
+    return db.query(UploadJob.id, UploadJob.staged_path).filter(
+        (UploadJob.status == "staged") | ((UploadJob.status == "processing") & (UploadJob.updated_at < stale_before))
+    ).order_by(UploadJob.created_at).all()
+
+def get_active_upload_job_ids(job_ids: list, db: Session) -> set:
+    '''Returns the ids of the jobs that are staged or being processed'''
+    return {
+        job_id for (job_id,) in db.query(UploadJob.id).filter(
+            UploadJob.id.in_(job_ids),
+            UploadJob.status.in_(("staged", "processing"))
+        )
+    }
+
+def delete_finished_upload_jobs(older_than: datetime, db: Session) -> int:
+    deleted = db.query(UploadJob).filter(
+        UploadJob.status.in_(("done", "failed")),
+        UploadJob.updated_at < older_than
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
 def delete_session(session, db):
     db.delete(session)
     db.commit()
 
-def delete_file_from_storage(file_id: str, user_id: str, db: Session):
-    file = db.query(File).filter(File.id == file_id, File.owner_user_id == user_id).first()
+def tombstone_file(file_id: str, user_id: str, db: Session):
+    '''Marks the file as deleted and removes its shares, the blob is removed later by the deletion worker'''
+    file = db.query(File).filter(
+        File.id == file_id,
+        File.owner_user_id == user_id,
+        File.deleted_at.is_(None)
+    ).first()
     if not file:
         raise FileNotFound("File not found or you do not have permission to delete it.")
-    file_size = os.path.getsize(file.location)
-    user = db.query(User).filter(User.id == user_id).first()
-    user.current_storage = max(0, user.current_storage - file_size)
-    file_path = file.location
-    db.delete(file)
+    file.deleted_at = datetime.now(UTC)
+    remove_file_shares_and_record_delete([file_id], db)
     db.commit()
-    return file_path
+
+def get_file_blob_locations(file_id: str, db: Session) -> list:
+    '''Retrieves the locations of the blob or of the chunks of all retained versions of the file'''
+    chunks = (
+        db.query(Chunk.location)
+        .join(FileVersionChunk, FileVersionChunk.chunk_id == Chunk.id)
+        .join(FileVersion, FileVersion.id == FileVersionChunk.version_id)
+        .filter(FileVersion.file_id == file_id)
+        .distinct()
+        .all()
+    )
+    blob = db.query(File.location).filter(File.id == file_id, File.location.isnot(None)).all()
+    return [location for (location,) in blob + chunks]
+
+def remove_file_shares_and_record_delete(file_ids: list, db: Session):
+    '''Drops the shares of the files and tells owners and recipients through the change log.
+    Does not commit, so it is part of the caller's transaction'''
+    owners = db.query(File.owner_user_id, File.id).filter(File.id.in_(file_ids)).all()
+    recipients = db.query(SharedFile.shared_user_id, SharedFile.file_id).filter(SharedFile.file_id.in_(file_ids)).all()
+    changes = [{"user_id": user_id, "file_id": file_id, "action": "delete"} for user_id, file_id in owners if user_id]
+    changes += [{"user_id": user_id, "file_id": file_id, "action": "unshare"} for user_id, file_id in recipients]
+    db.query(SharedFile).filter(SharedFile.file_id.in_(file_ids)).delete(synchronize_session=False)
+    record_changes(changes, db)
+
+def get_tombstoned_files(db: Session, limit: int):
+    '''Retrieves the oldest deleted files whose blobs still have to be removed'''
+    return (
+        db.query(File.id, File.location, File.owner_user_id, File.size)
+        .filter(File.deleted_at.isnot(None))
+        .order_by(func.coalesce(File.purge_attempts, 0), File.deleted_at)
+        .limit(limit)
+        .all()
+    )
+
+def get_version_sizes(file_ids: list, db: Session) -> dict:
+    '''Retrieves the total size of the retained versions of each file'''
+    rows = (
+        db.query(FileVersion.file_id, func.sum(FileVersion.size))
+        .filter(FileVersion.file_id.in_(file_ids))
+        .group_by(FileVersion.file_id)
+        .all()
+    )
+    return {file_id: int(size or 0) for file_id, size in rows}
+
+def purge_file_rows(file_ids: list, freed_bytes_by_user: dict, failed_ids: list, db: Session):
+    '''Deletes the rows of files whose blobs are gone and gives the space back to their owners.
+    Files that failed are pushed back so they do not hold up the rest of the queue'''
+    if failed_ids:
+        db.execute(
+            update(File)
+            .where(File.id.in_(failed_ids))
+            .values(purge_attempts=func.coalesce(File.purge_attempts, 0) + 1)
+        )
+    for user_id, freed_bytes in freed_bytes_by_user.items():
+        db.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(current_storage=case(
+                (User.current_storage > freed_bytes, User.current_storage - freed_bytes),
+                else_=0
+            ))
+        )
+    if file_ids:
+        version_ids = select(FileVersion.id).where(FileVersion.file_id.in_(file_ids))
+        db.query(FileVersionChunk).filter(FileVersionChunk.version_id.in_(version_ids)).delete(synchronize_session=False)
+        db.query(FileVersion).filter(FileVersion.file_id.in_(file_ids)).delete(synchronize_session=False)
+        db.query(File).filter(File.id.in_(file_ids)).delete(synchronize_session=False)
+    db.commit()
+
+def get_changes_since(user_id: str, cursor: int, db: Session, limit: int):
+    '''Retrieves the user's changes after the cursor, collapsed to the last action per file.
+    No change of the user can commit with an id at or below a cursor handed out, see record_changes'''
+    floor = db.query(User.change_log_floor).filter(User.id == user_id).scalar() or 0
+    if cursor < floor:
+        # The entries after the cursor were compacted away
+        latest = db.query(func.max(FileChange.id)).filter(FileChange.user_id == user_id).scalar() or floor
+        return {"reset": True, "cursor": latest, "has_more": False, "changes": []}
+    # A cursor past the newest entry here was handed out by the primary or a replica further
+    # along. It gets no changes until this database caught up, which is not a reason to resync
+
+    entries = (
+        db.query(FileChange.id, FileChange.file_id, FileChange.action)
+        .filter(FileChange.user_id == user_id, FileChange.id > cursor)
+        .order_by(FileChange.id)
+        .limit(limit + 1)
+        .all()
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    last_action = {}
+    for change_id, file_id, action in entries:
+        last_action.pop(file_id, None)  # keep the dict in order of the last change
+        last_action[file_id] = action
+
+    added_ids = [file_id for file_id, action in last_action.items() if action in ("upload", "share")]
+    files = {}
+    if added_ids:
+        for file in db.query(File).filter(File.id.in_(added_ids), File.deleted_at.is_(None)):
+            files[file.id] = {
+                "id": file.id,
+                "created_at": file.created_at.isoformat(),
+                "file_name": file.file_name,
+                "owner_user_id": file.owner_user_id
+            }
+
+    changes = []
+    for file_id, action in last_action.items():
+        change = {"file_id": file_id, "action": action}
+        if action in ("upload", "share"):
+            if file_id not in files:
+                continue  # deleted since, its delete/unshare entry comes in a later page
+            change["file"] = files[file_id]
+        changes.append(change)
+
+    return {
+        "reset": False,
+        "cursor": entries[-1][0] if entries else cursor,
+        "has_more": has_more,
+        "changes": changes
+    }
+
+def compact_change_log(older_than: datetime, db: Session, batch_size: int = 10000) -> int:
+    '''Deletes change log entries older than the cutoff, raising each user's floor first
+    so clients holding an older cursor are told to resync instead of missing changes'''
+    cutoff_id = db.query(func.max(FileChange.id)).filter(FileChange.created_at < older_than).scalar()
+    if cutoff_id is None:
+        return 0
+    compacted = select(func.max(FileChange.id)).where(
+        FileChange.user_id == User.id,
+        FileChange.id <= cutoff_id
+    ).scalar_subquery()
+    db.execute(
+        update(User)
+        .where(exists().where(FileChange.user_id == User.id, FileChange.id <= cutoff_id))
+        .values(change_log_floor=compacted)
+    )
+    db.commit()
+
+    deleted = 0
+    low_id = db.query(func.min(FileChange.id)).scalar()
+    while low_id is not None and low_id <= cutoff_id:
+        high_id = min(low_id + batch_size, cutoff_id + 1)
+        deleted += db.execute(
+            delete(FileChange).where(FileChange.id >= low_id, FileChange.id < high_id)
+        ).rowcount
+        db.commit()
+        low_id = high_id
+    return deleted
 
 def upgrade_user_plan(user_id:str, db:Session):
     user = db.query(User).filter(User.id == user_id).first()
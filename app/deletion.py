@@ -0,0 +1,79 @@
+'''Removes the blobs of tombstoned files in the background so deletes return right away'''
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import Session
+from app.background import PeriodicWorker
+from app.cache import blob_cache
+from app.crud import get_tombstoned_files, get_version_sizes, purge_file_rows
+from app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "200"))
+DELETE_UNLINK_THREADS = int(os.getenv("DELETE_UNLINK_THREADS", "8"))
+DELETE_INTERVAL_SECONDS = int(os.getenv("DELETE_INTERVAL_SECONDS", "30"))
+
+_unlink_pool = ThreadPoolExecutor(max_workers=DELETE_UNLINK_THREADS, thread_name_prefix="unlink")
+
+
+def unlink_blob(location: str):
+    '''Removes the blob and returns its size, or None if it could not be removed'''
+    try:
+        size = os.path.getsize(location)
+        os.remove(location)
+        return size
+    except FileNotFoundError:
+        return 0
+    except OSError:
+        logger.exception("Could not remove %s, will retry", location)
+        return None
+
+
+def purge_deleted_files(db: Session, batch_size: int = DELETE_BATCH_SIZE) -> int:
+    '''Unlinks the blobs of one batch of tombstoned files and drops their rows.
+
+    Files whose blob could not be removed keep their row and are retried on the next run.
+    Versioned files have no blob of their own, their chunks are left to chunk garbage collection.
+    '''
+    files = get_tombstoned_files(db, batch_size)
+    if not files:
+        return 0
+    blob_files = [file for file in files if file.location is not None]
+    blob_cache.invalidate([file.location for file in blob_files])
+    version_sizes = get_version_sizes([file.id for file in files if file.location is None], db)
+    sizes = dict(zip(
+        [file.id for file in blob_files],
+        _unlink_pool.map(unlink_blob, [file.location for file in blob_files])
+    ))
+    sizes.update((file.id, version_sizes.get(file.id, 0)) for file in files if file.location is None)
+
+    purged_ids = []
+    failed_ids = []
+    freed_bytes_by_user = defaultdict(int)
+    for file in files:
+        size = sizes[file.id]
+        if size is None:
+            failed_ids.append(file.id)
+            continue
+        purged_ids.append(file.id)
+        if file.location is not None and file.size is not None:
+            # Uploads were charged the plaintext size, the blob on disk is larger
+            size = file.size
+        freed_bytes_by_user[file.owner_user_id] += size
+    purge_file_rows(purged_ids, freed_bytes_by_user, failed_ids, db)
+    return len(purged_ids)
+
+
+def run_deletion_job():
+    db = SessionLocal()
+    try:
+        # Keep going while full batches come back so a burst of deletes drains in one run
+        while purge_deleted_files(db) >= DELETE_BATCH_SIZE:
+            pass
+    finally:
+        db.close()
+
+
+deletion_worker = PeriodicWorker("deletion", run_deletion_job, DELETE_INTERVAL_SECONDS)
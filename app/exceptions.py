@@ -16,4 +16,7 @@ class FilePermissionError(AppBaseException):
     pass
 
 class FileNotFound(AppBaseException):
+    pass
+
+class UploadJobTakenOver(AppBaseException):
     pass
\ No newline at end of file
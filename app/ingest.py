@@ -0,0 +1,193 @@
+'''Staged uploads.
+
+POST /file/upload/staged/ copies the upload as is into a private staging directory, records an
+upload job and returns 202. A bounded pool of threads then chunks, checksums, encrypts and stores
+it like a regular upload, and GET /file/upload/status/ reports how far it got. Jobs left behind
+by a stopped process are picked up again by the recovery job, which runs at startup and then
+every INGEST_RECOVERY_INTERVAL_SECONDS.
+'''
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, UTC
+from uuid import uuid4
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+from app.background import PeriodicWorker
+from app.crud import (
+    create_upload_job, claim_upload_job, update_upload_job_progress, fail_upload_job,
+    get_recoverable_upload_jobs, get_active_upload_job_ids, delete_finished_upload_jobs
+)
+from app.database import SessionLocal
+from app.exceptions import UploadJobTakenOver
+from app.metrics import metrics
+from app.models import User
+from app.profiling import span
+from app.storage import store_file_version
+from app.volumes import volumes
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Holds unencrypted uploads until they are processed. Hidden inside the first volume by
+# default, so reconciliation leaves it alone
+INGEST_STAGING_LOCATION = os.getenv("INGEST_STAGING_LOCATION") or os.path.join(volumes[0].path, ".staging")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Staged uploads waiting in this process before new ones are turned away with 503
+INGEST_MAX_QUEUED = int(os.getenv("INGEST_MAX_QUEUED", "100"))
+# A processing job whose progress did not move for this long is taken over by recovery
+INGEST_STALE_SECONDS = int(os.getenv("INGEST_STALE_SECONDS", "300"))
+INGEST_RECOVERY_INTERVAL_SECONDS = int(os.getenv("INGEST_RECOVERY_INTERVAL_SECONDS", "300"))
+INGEST_JOB_RETENTION_SECONDS = int(os.getenv("INGEST_JOB_RETENTION_SECONDS", str(7 * 24 * 60 * 60)))
+PROGRESS_INTERVAL_BYTES = 8 * 1024 * 1024
+STAGING_COPY_BUFFER = 1024 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_queued = set()
+_queued_lock = threading.Lock()
+
+
+def queue_full() -> bool:
+    with _queued_lock:
+        return len(_queued) >= INGEST_MAX_QUEUED
+
+
+def submit(job_id: str):
+    with _queued_lock:
+        if job_id in _queued:
+            return
+        _queued.add(job_id)
+    _executor.submit(process_upload_job, job_id)
+
+
+def stage_upload(db: Session, user_id: str, file_name: str, content_type: str, stream):
+    '''Writes the upload to the staging directory, records the job and queues it'''
+    job_id = str(uuid4())
+    os.makedirs(INGEST_STAGING_LOCATION, mode=0o700, exist_ok=True)
+    staged_path = os.path.join(INGEST_STAGING_LOCATION, job_id)
+    fd = os.open(staged_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with span("io"), os.fdopen(fd, "wb") as staged:
+            shutil.copyfileobj(stream, staged, STAGING_COPY_BUFFER)
+            size = staged.tell()
+            # The 202 promises the upload is kept
+            staged.flush()
+            os.fsync(staged.fileno())
+        job = create_upload_job(job_id, user_id, file_name, content_type, staged_path, size, db)
+    except BaseException:
+        _remove_staged(staged_path)
+        raise
+    metrics.inc("ingest_staged_bytes", size)
+    submit(job_id)
+    return job
+
+
+class ProgressReader:
+    '''Reports how much of the staged file was read to the job row as it goes'''
+
+    def __init__(self, stream, job_id: str, claim: str, db: Session):
+        self.stream = stream
+        self.job_id = job_id
+        self.claim = claim
+        self.db = db
+        self.read_bytes = 0
+        self._reported = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.read_bytes += len(data)
+        if self.read_bytes - self._reported >= PROGRESS_INTERVAL_BYTES:
+            update_upload_job_progress(self.job_id, self.claim, self.read_bytes, self.db)
+            self._reported = self.read_bytes
+        return data
+
+
+def _stale_before() -> datetime:
+    return datetime.now(UTC) - timedelta(seconds=INGEST_STALE_SECONDS)
+
+
+def _remove_staged(staged_path: str):
+    try:
+        os.remove(staged_path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Removed by the recovery job later
+        logger.exception("Could not remove staged upload %s", staged_path)
+
+
+def process_upload_job(job_id: str):
+    db = SessionLocal()
+    try:
+        job = claim_upload_job(job_id, _stale_before(), db)
+        if job is None:
+            return
+        user = db.query(User).filter(User.id == job.user_id).first()
+        try:
+            with metrics.timer("ingest_process_seconds"), open(job.staged_path, 'rb') as staged:
+                store_file_version(
+                    db, user, job.file_name, ProgressReader(staged, job_id, job.claim, db), job.content_type,
+                    upload_job_id=job_id, upload_claim=job.claim
+                )
+            metrics.inc("ingest_jobs", status="done")
+        except UploadJobTakenOver:
+            # Stalled long enough for recovery to hand it to another worker, which needs the staged file
+            logger.warning("Staged upload %s was claimed again, dropping this attempt", job_id)
+            metrics.inc("ingest_jobs", status="taken_over")
+            return
+        except Exception:
+            db.rollback()
+            logger.exception("Could not store staged upload %s", job_id)
+            if not fail_upload_job(job_id, "The upload could not be stored, please upload it again", db, job.claim):
+                return
+            metrics.inc("ingest_jobs", status="failed")
+        _remove_staged(job.staged_path)
+    finally:
+        with _queued_lock:
+            _queued.discard(job_id)
+        db.close()
+
+
+def _remove_orphan_staged_files(db: Session):
+    '''Removes staged files of finished jobs and of jobs never recorded'''
+    try:
+        entries = [entry for entry in os.scandir(INGEST_STAGING_LOCATION) if entry.is_file(follow_symlinks=False)]
+    except FileNotFoundError:
+        return
+    # Files of uploads still being staged are younger than this
+    older_than = _stale_before().timestamp()
+    candidates = {entry.name: entry.path for entry in entries if entry.stat().st_mtime < older_than}
+    if candidates:
+        active = get_active_upload_job_ids(list(candidates), db)
+        for job_id, staged_path in candidates.items():
+            if job_id not in active:
+                _remove_staged(staged_path)
+
+
+def recover_upload_jobs():
+    '''Queues staged and stalled jobs again, cleans up the staging directory and forgets old jobs'''
+    db = SessionLocal()
+    try:
+        for job_id, staged_path in get_recoverable_upload_jobs(_stale_before(), db):
+            if os.path.exists(staged_path):
+                submit(job_id)
+            else:
+                fail_upload_job(job_id, "The upload was lost, please upload it again", db)
+        _remove_orphan_staged_files(db)
+        delete_finished_upload_jobs(datetime.now(UTC) - timedelta(seconds=INGEST_JOB_RETENTION_SECONDS), db)
+    finally:
+        db.close()
+
+
+def shutdown_ingest():
+    '''Stops taking queued jobs, they stay staged and are resumed by the next process'''
+    global _executor
+    executor, _executor = _executor, ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+ingest_recovery_worker = PeriodicWorker("ingest-recovery", recover_upload_jobs, INGEST_RECOVERY_INTERVAL_SECONDS)
+metrics.register_gauge("ingest_queued_jobs", lambda: [({}, len(_queued))])
@@ -0,0 +1,135 @@
+'''Picks the process that runs the background jobs.
+
+uvicorn --workers starts the app in several processes, and several containers can share one
+database. Jobs on shared state (deletion, garbage collection, rebalancing, tiering, ...) run in
+one of them at a time: the process holding a PostgreSQL advisory lock, or an exclusive lock on a
+file with SQLite. The others try to take the lock every LEADER_RETRY_SECONDS, which succeeds
+once the leader stops or loses its database connection.
+'''
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import NullPool
+from app.background import PeriodicWorker, start_workers, stop_workers
+from app.database import SQLALCHEMY_DATABASE_URL
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "15"))
+# Any number, the same for every process of a deployment
+LEADER_LOCK_ID = int(os.getenv("LEADER_LOCK_ID", "7315"))
+
+
+class AdvisoryLock:
+    '''A PostgreSQL session advisory lock, held as long as its connection stays open'''
+
+    def __init__(self, url: str, lock_id: int):
+        # A connection of its own, outside the request pools
+        self.engine = create_engine(url, poolclass=NullPool, isolation_level="AUTOCOMMIT")
+        self.lock_id = lock_id
+        self._connection = None
+
+    def acquire(self) -> bool:
+        if self._connection is not None:
+            try:
+                self._connection.execute(text("SELECT 1"))
+                return True
+            except SQLAlchemyError:
+                # The server dropped the lock with the connection
+                self.release()
+        connection = self.engine.connect()
+        try:
+            locked = connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": self.lock_id}).scalar()
+        except SQLAlchemyError:
+            connection.close()
+            raise
+        if not locked:
+            connection.close()
+            return False
+        self._connection = connection
+        return True
+
+    def release(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except SQLAlchemyError:
+                pass
+            self._connection = None
+
+
+class FileLock:
+    '''An exclusive lock on a file, for the processes of one host sharing a SQLite database'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Leader:
+    '''Starts the registered workers while this process holds the lock'''
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.is_leader = False
+        self.worker = PeriodicWorker("leader-election", self.check, LEADER_RETRY_SECONDS)
+
+    def check(self):
+        try:
+            held = self.lock.acquire()
+        except SQLAlchemyError:
+            logger.warning("Could not reach the database to take the leader lock")
+            held = False
+        if held and not self.is_leader:
+            logger.info("Process %d runs the background jobs", os.getpid())
+            start_workers()
+        elif not held and self.is_leader:
+            logger.warning("Lost the leader lock, stopping the background jobs")
+            stop_workers()
+        self.is_leader = held
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.worker.stop()
+        if self.is_leader:
+            stop_workers()
+            self.is_leader = False
+        self.lock.release()
+
+
+def _lock():
+    if SQLALCHEMY_DATABASE_URL.startswith("postgresql"):
+        return AdvisoryLock(SQLALCHEMY_DATABASE_URL, LEADER_LOCK_ID)
+    name = hashlib.sha256(SQLALCHEMY_DATABASE_URL.encode()).hexdigest()[:16]
+    return FileLock(os.path.join(tempfile.gettempdir(), f"minivault-{name}.leader"))
+
+
+leader = Leader(_lock())
+metrics.register_gauge("background_leader", lambda: [({}, int(leader.is_leader))])
@@ -1,9 +1,63 @@
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from app.error_handlers import register_error_handlers
 from app.api import router as api_router
+from app.background import PeriodicWorker, register_worker, start_process_workers, stop_process_workers
+from app.reconcile import run_reconcile_job
+from app.deletion import deletion_worker
+from app.changes import compaction_worker
+from app.storage import chunk_gc_worker
+from app.volumes import rebalance_worker, cold_volume
+from app.tiering import access_flush_worker, tiering_worker, promotion_worker, run_access_flush_job
+from app.database import replicas, replica_check_worker, warm_pools
+from app.ingest import ingest_recovery_worker, shutdown_ingest
+from app.leader import leader
+from app.metrics import metrics
+from app import profiling
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# The schema is created and migrated by `python -m app.migrate`, before the app starts
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    await run_in_threadpool(warm_pools)
+    start_process_workers()
+    leader.start()
+    app.state.ready = True
+    startup_seconds = time.perf_counter() - started
+    metrics.observe("startup_seconds", startup_seconds)
+    logger.info("Process %d ready in %.3fs", os.getpid(), startup_seconds)
+    yield
+    app.state.ready = False
+    leader.stop()
+    stop_process_workers()
+    shutdown_ingest()
+    # Download statistics collected since the last flush
+    run_access_flush_job()
+
+app = FastAPI(default_response_class=profiling.response_class, lifespan=lifespan)
+
+register_worker(deletion_worker)
+register_worker(compaction_worker)
+register_worker(chunk_gc_worker)
+register_worker(rebalance_worker)
+register_worker(ingest_recovery_worker)
+register_worker(access_flush_worker, every_process=True)
+if cold_volume is not None:
+    register_worker(tiering_worker)
+    register_worker(promotion_worker, every_process=True)
+if replicas:
+    register_worker(replica_check_worker, every_process=True)
+
+reconcile_interval = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "0"))
+if reconcile_interval > 0:
+    register_worker(PeriodicWorker("reconcile", run_reconcile_job, reconcile_interval))
 
 # Register error handlers
 register_error_handlers(app)
@@ -18,6 +72,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+if profiling.PROFILING_ENABLED:
+    profiling.install(app)
 # structure ref - https://blog.stackademic.com/using-fastapi-with-sqlalchemy-5cd370473fe5
 #  file upload - https://stackoverflow.com/questions/65342833/fastapi-uploadfile-is-slow-compared-to-flask/70667530#70667530
 # https://stackoverflow.com/questions/63048825/how-to-upload-file-using-fastapi
@@ -0,0 +1,56 @@
+'''In-process counters, timers and gauges served by GET /metrics/'''
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._gauges = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            count, total, longest = self._timers.get(key, (0, 0.0, 0.0))
+            self._timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_gauge(self, name: str, read):
+        '''read() is called on every snapshot and returns a list of (labels, value)'''
+        self._gauges[name] = read
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            timers = dict(self._timers)
+        result = {"counters": {}, "timers": {}, "gauges": {}}
+        for (name, labels), value in counters.items():
+            result["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), (count, total, longest) in timers.items():
+            result["timers"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": count,
+                "sum_seconds": total,
+                "max_seconds": longest
+            })
+        for name, read in self._gauges.items():
+            result["gauges"][name] = [{"labels": labels, "value": value} for labels, value in read()]
+        return result
+
+
+metrics = Metrics()
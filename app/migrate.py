@@ -0,0 +1,40 @@
+'''Brings the database schema up to date, run once per deploy before the app starts:
+
+    python -m app.migrate
+
+An empty database gets the current schema and is stamped with the latest migration, as the early
+migrations cannot build it from nothing. Databases the app created itself before migrations were
+part of deploys have tables but no alembic_version table; their schema is that of
+BASELINE_REVISION, so they are stamped with it and upgraded from there.
+'''
+import logging
+import os
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+from app import models
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+BASELINE_REVISION = "64ee116a4ac8"
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+
+def migrate():
+    config = Config(ALEMBIC_INI)
+    tables = inspect(engine).get_table_names()
+    if "alembic_version" not in tables:
+        if models.User.__tablename__ not in tables:
+            logger.info("Empty database, creating the schema")
+            models.Base.metadata.create_all(bind=engine)
+            command.stamp(config, "head")
+            return
+        logger.info("Database without migration history, stamping it with %s", BASELINE_REVISION)
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, "head")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
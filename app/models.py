@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, JSON, BigInteger
+from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, JSON, BigInteger, Integer, Index, UniqueConstraint, text
 from app.database import Base
 from datetime import datetime, UTC
 from uuid import uuid4
@@ -10,6 +10,8 @@ class User(Base):
     is_paid = Column(Boolean, default=False)
     created_at = Column(DateTime, default=lambda: datetime.now(UTC))
     current_storage = Column(BigInteger, default=0)
+    # Highest change id removed by compaction, older cursors have to resync
+    change_log_floor = Column(BigInteger, default=0)
 
 
 class AuthCode(Base):
@@ -37,8 +39,94 @@ class File(Base):
     checksum = Column(String, nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(UTC))
     owner_user_id = Column(String, ForeignKey("users.id"))
+    # Path of the blob for files uploaded before versioning, versioned files keep their content in chunks
+    location = Column(String, nullable=True)
+    file_name = Column(String, nullable=False)
+    current_version = Column(Integer, nullable=True)
+    deleted_at = Column(DateTime, nullable=True, index=True)
+    purge_attempts = Column(Integer, default=0)
+    # Download statistics, flushed from memory in batches (see app.tiering)
+    last_accessed_at = Column(DateTime, nullable=True)
+    access_count = Column(BigInteger, default=0)
+    # "zlib" when the blob was recompressed on the cold tier
+    compression = Column(String, nullable=True)
+    # Of the current version: plaintext bytes, encrypted bytes as written and MIME type
+    size = Column(BigInteger, nullable=True)
+    stored_size = Column(BigInteger, nullable=True)
+    content_type = Column(String, nullable=True)
+
+    __table_args__ = (
+        # Covers the storage breakdown aggregates
+        Index(
+            "ix_files_owner_user_id_content_type_created_at",
+            "owner_user_id", "content_type", "created_at",
+            postgresql_include=["size", "stored_size", "deleted_at"]
+        ),
+        # Uploads of a name add versions to one file. Files uploaded before versioning may share names
+        Index(
+            "uq_files_owner_user_id_file_name_live",
+            "owner_user_id", "file_name",
+            unique=True,
+            postgresql_where=text("deleted_at IS NULL AND location IS NULL"),
+            sqlite_where=text("deleted_at IS NULL AND location IS NULL")
+        ),
+    )
+
+
+class FileVersion(Base):
+    __tablename__ = "file_versions"
+    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    file_id = Column(String, ForeignKey("files.id"), nullable=False)
+    version = Column(Integer, nullable=False)
+    checksum = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC))
+
+    __table_args__ = (UniqueConstraint("file_id", "version", name="uq_file_versions_file_id_version"),)
+
+
+class FileVersionChunk(Base):
+    __tablename__ = "file_version_chunks"
+    version_id = Column(String, ForeignKey("file_versions.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    chunk_id = Column(String, ForeignKey("chunks.id"), nullable=False, index=True)
+
+
+class Chunk(Base):
+    __tablename__ = "chunks"
+    # Keyed HMAC of the plaintext, so identical content is stored once
+    id = Column(String, primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    stored_size = Column(BigInteger, nullable=False)
     location = Column(String, nullable=False)
+    # Name of the storage volume holding the blob
+    volume = Column(String, nullable=True, index=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC))
+    # Bumped whenever an upload reuses the chunk, garbage collection leaves recently seen chunks alone
+    last_seen_at = Column(DateTime, default=lambda: datetime.now(UTC), index=True)
+    # "zlib" when the chunk was recompressed on the cold tier
+    compression = Column(String, nullable=True)
+
+
+class UploadJob(Base):
+    __tablename__ = "upload_jobs"
+    id = Column(String, primary_key=True, default=lambda: str(uuid4()))
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
     file_name = Column(String, nullable=False)
+    content_type = Column(String, nullable=True)
+    # Unencrypted upload waiting in the staging directory
+    staged_path = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False, default="staged", index=True)  # staged, processing, done or failed
+    # New on every claim, only the latest claimant may report progress on and complete the job
+    claim = Column(String, nullable=True)
+    processed_bytes = Column(BigInteger, default=0)
+    file_id = Column(String, nullable=True)
+    version = Column(Integer, nullable=True)
+    checksum = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC))
+    updated_at = Column(DateTime, default=lambda: datetime.now(UTC))
 
 
 class SharedFile(Base):
@@ -48,3 +136,16 @@ class SharedFile(Base):
     shared_user_id = Column(String, ForeignKey("users.id"))
     shared_at = Column(DateTime, default=lambda: datetime.now(UTC))
     permission = Column(String, default="read")
+
+    __table_args__ = (UniqueConstraint("file_id", "shared_user_id", name="uq_shared_files_file_id_shared_user_id"),)
+
+
+class FileChange(Base):
+    __tablename__ = "file_changes"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    file_id = Column(String, nullable=False)
+    action = Column(String, nullable=False)  # upload, delete, share or unshare
+    created_at = Column(DateTime, default=lambda: datetime.now(UTC), index=True)
+
+    __table_args__ = (Index("ix_file_changes_user_id_id", "user_id", "id"),)
@@ -0,0 +1,318 @@
+'''Opt-in per-request profiling.
+
+With PROFILING_ENABLED=true a request is profiled when it carries `X-Profile: <ADMIN_TOKEN>`,
+when it is picked by PROFILE_SAMPLE_RATE, or always when PROFILE_SLOW_MS is set (then only
+requests slower than that are kept). A profile has the time spent in DB queries, crypto,
+file I/O and JSON serialization, plus call stacks sampled from the threads working on the
+request. Profiles are kept in a bounded ring buffer served by /admin/profiles/.
+
+When PROFILING_ENABLED is not set nothing is installed and span() returns a shared no-op.
+'''
+import asyncio
+import functools
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime, UTC
+from uuid import uuid4
+from dotenv import load_dotenv
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+load_dotenv()
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+PROFILE_STACK_INTERVAL_SECONDS = float(os.getenv("PROFILE_STACK_INTERVAL_SECONDS", "0.005"))
+
+SPAN_KINDS = ("db", "crypto", "io", "serialization")
+MAX_STACK_DEPTH = 64
+
+_current_profile = ContextVar("current_profile", default=None)
+profiles = deque(maxlen=PROFILE_BUFFER_SIZE)
+
+
+def is_admin_token(value) -> bool:
+    '''Compares in constant time, value may be str or bytes'''
+    if ADMIN_TOKEN is None or value is None:
+        return False
+    if isinstance(value, str):
+        value = value.encode()
+    return hmac.compare_digest(value, ADMIN_TOKEN.encode())
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, reason: str):
+        self.id = uuid4().hex
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.status = None
+        self.started_at = datetime.now(UTC)
+        self.duration_ms = None
+        self.spans = {kind: [0, 0.0] for kind in SPAN_KINDS}
+        self.stacks = Counter()
+        self.threads = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, kind: str, seconds: float):
+        with self._lock:
+            self.spans[kind][0] += 1
+            self.spans[kind][1] += seconds
+
+    def enter_thread(self):
+        thread_id = threading.get_ident()
+        with self._lock:
+            self.threads[thread_id] = self.threads.get(thread_id, 0) + 1
+
+    def exit_thread(self):
+        thread_id = threading.get_ident()
+        with self._lock:
+            if self.threads.get(thread_id, 0) <= 1:
+                self.threads.pop(thread_id, None)
+            else:
+                self.threads[thread_id] -= 1
+
+    def sample_count(self) -> int:
+        with self._lock:
+            return sum(self.stacks.values())
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def breakdown(self) -> dict:
+        elapsed_ms = self.duration_ms if self.duration_ms is not None else (time.perf_counter() - self._start) * 1000
+        with self._lock:
+            spans = {kind: {"count": count, "ms": round(seconds * 1000, 3)} for kind, (count, seconds) in self.spans.items()}
+        spans["other"] = {"ms": round(max(0.0, elapsed_ms - sum(span["ms"] for span in spans.values())), 3)}
+        return spans
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{kind};dur={span['ms']}" for kind, span in self.breakdown().items())
+
+    def to_dict(self, with_stacks: bool = False) -> dict:
+        result = {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": self.duration_ms,
+            "breakdown": self.breakdown(),
+            "samples": self.sample_count()
+        }
+        if with_stacks:
+            with self._lock:
+                stacks = self.stacks.most_common(200)
+            # Collapsed stacks, root first, as used by flame graph tools
+            result["stacks"] = [{"stack": stack, "samples": samples} for stack, samples in stacks]
+        return result
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, profile: RequestProfile, kind: str):
+        self.profile = profile
+        self.kind = kind
+
+    def __enter__(self):
+        self.profile.enter_thread()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.kind:
+            self.profile.add_span(self.kind, time.perf_counter() - self._start)
+        self.profile.exit_thread()
+        return False
+
+
+def span(kind: str):
+    '''Times the block as one of SPAN_KINDS when the current request is being profiled'''
+    if not PROFILING_ENABLED:
+        return _NOOP_SPAN
+    profile = _current_profile.get()
+    if profile is None:
+        return _NOOP_SPAN
+    return _Span(profile, kind)
+
+
+class StackSampler:
+    '''Samples the stacks of the threads registered by the active profiles'''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._profiles = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def remove(self, profile: RequestProfile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                active = list(self._profiles)
+            if not active:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            for profile in active:
+                with profile._lock:
+                    thread_ids = list(profile.threads)
+                for thread_id in thread_ids:
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stack = _collapse(frame)
+                        with profile._lock:
+                            profile.stacks[stack] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+sampler = StackSampler(PROFILE_STACK_INTERVAL_SECONDS)
+
+
+class ProfilingMiddleware:
+    '''Pure ASGI middleware, so the profile is set in the request's context before the
+    endpoint runs and contextvars carry it into the threadpool'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        requested = is_admin_token(dict(scope["headers"]).get(b"x-profile"))
+        if requested:
+            reason = "requested"
+        elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            reason = "sampled"
+        elif PROFILE_SLOW_MS:
+            reason = "slow"
+        else:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"], reason)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                if requested:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-profile-id", profile.id.encode()))
+                    headers.append((b"server-timing", profile.server_timing().encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current_profile.set(profile)
+        sampler.add(profile)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            sampler.remove(profile)
+            _current_profile.reset(token)
+            profile.finish()
+            if reason != "slow" or profile.duration_ms >= PROFILE_SLOW_MS:
+                profiles.append(profile)
+
+
+def _track_thread(endpoint):
+    '''Registers the threadpool thread running a sync endpoint for stack sampling'''
+    if asyncio.iscoroutinefunction(endpoint):
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def tracked(*args, **kwargs):
+        profile = _current_profile.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        with _Span(profile, None):
+            return endpoint(*args, **kwargs)
+    return tracked
+
+
+class ProfiledRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _track_thread(endpoint), **kwargs)
+
+
+class ProfiledJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with span("serialization"):
+            return super().render(content)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.enter_thread()
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is not None and conn.info.get("profile_query_start"):
+        profile.add_span("db", time.perf_counter() - conn.info["profile_query_start"].pop())
+        profile.exit_thread()
+
+
+def _handle_error(context):
+    profile = _current_profile.get()
+    if profile is not None and context.connection is not None and context.connection.info.get("profile_query_start"):
+        context.connection.info["profile_query_start"].pop()
+        profile.exit_thread()
+
+
+def install(app):
+    '''Adds the middleware and DB hooks, called by app.main only when profiling is enabled'''
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    app.add_middleware(ProfilingMiddleware)
+
+
+route_class = ProfiledRoute if PROFILING_ENABLED else APIRoute
+response_class = ProfiledJSONResponse if PROFILING_ENABLED else JSONResponse
@@ -0,0 +1,192 @@
+'''Finds blobs in the storage volumes without a files/chunks row, and rows without a blob.
+
+Run it by hand with `python -m app.reconcile` (dry run by default) or periodically by
+setting RECONCILE_INTERVAL_SECONDS.
+'''
+import argparse
+import logging
+import os
+import time
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.crud import remove_file_shares_and_record_delete
+from app.models import File, Chunk
+from app.volumes import all_volumes
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = ".quarantine"
+DEFAULT_GRACE_SECONDS = 60 * 60
+DEFAULT_BATCH_SIZE = 500
+
+
+def iter_storage_batches(root: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    '''Streams the blobs under root in batches, skipping hidden directories like the quarantine'''
+    pending_dirs = [root]
+    batch = []
+    while pending_dirs:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    batch.append(entry)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+    if batch:
+        yield batch
+
+
+def find_orphan_blobs(db: Session, root: str, grace_seconds: int = DEFAULT_GRACE_SECONDS, batch_size: int = DEFAULT_BATCH_SIZE):
+    '''Yields blobs that no files or chunks row points to and that are older than the grace period'''
+    cutoff = time.time() - grace_seconds
+    for batch in iter_storage_batches(root, batch_size):
+        paths = [entry.path for entry in batch]
+        known = {location for (location,) in db.query(File.location).filter(File.location.in_(paths))}
+        known.update(location for (location,) in db.query(Chunk.location).filter(Chunk.location.in_(paths)))
+        for entry in batch:
+            if entry.path in known:
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                    continue  # probably an upload that has not been committed yet
+            except FileNotFoundError:
+                continue
+            yield entry.path
+
+
+def find_dangling_files(db: Session, batch_size: int = DEFAULT_BATCH_SIZE):
+    '''Yields a list of (file_id, location) per page of files rows whose blob is missing.
+    Deleted files are left to the deletion worker'''
+    last_id = ""
+    while True:
+        rows = (
+            db.query(File.id, File.location)
+            .filter(File.id > last_id, File.deleted_at.is_(None), File.location.isnot(None))
+            .order_by(File.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return
+        # Rows up to last_id are never read again, so callers may delete them between pages
+        last_id = rows[-1][0]
+        yield [(file_id, location) for file_id, location in rows if not os.path.exists(location)]
+
+
+def find_missing_chunks(db: Session, batch_size: int = DEFAULT_BATCH_SIZE):
+    '''Yields (chunk_id, location) of chunks whose blob is missing'''
+    last_id = ""
+    while True:
+        rows = (
+            db.query(Chunk.id, Chunk.location)
+            .filter(Chunk.id > last_id)
+            .order_by(Chunk.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        for chunk_id, location in rows:
+            if not os.path.exists(location):
+                yield chunk_id, location
+
+
+def quarantine_blob(root: str, path: str):
+    '''Moves the blob into the quarantine directory, keeping its path relative to root'''
+    target = os.path.join(root, QUARANTINE_DIR, os.path.relpath(path, root))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    return target
+
+
+def reconcile(
+        db: Session,
+        roots: list,
+        dry_run: bool = True,
+        prune_dangling: bool = False,
+        grace_seconds: int = DEFAULT_GRACE_SECONDS,
+        batch_size: int = DEFAULT_BATCH_SIZE
+    ):
+    '''Reports orphan blobs and dangling rows; quarantines/prunes them unless dry_run'''
+    report = {"orphan_blobs": 0, "quarantined": 0, "dangling_files": 0, "pruned_files": 0, "missing_chunks": 0}
+
+    for root in roots:
+        for path in find_orphan_blobs(db, root, grace_seconds, batch_size):
+            report["orphan_blobs"] += 1
+            logger.info("Orphan blob: %s", path)
+            if not dry_run:
+                try:
+                    quarantine_blob(root, path)
+                    report["quarantined"] += 1
+                except FileNotFoundError:
+                    pass
+
+    for dangling in find_dangling_files(db, batch_size):
+        for file_id, location in dangling:
+            report["dangling_files"] += 1
+            logger.info("Dangling file row: %s -> %s", file_id, location)
+        if dangling and not dry_run and prune_dangling:
+            ids = [file_id for file_id, _ in dangling]
+            remove_file_shares_and_record_delete(ids, db)
+            report["pruned_files"] += db.query(File).filter(File.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+
+    # Every version using a missing chunk is unreadable, this can only be reported
+    for chunk_id, location in find_missing_chunks(db, batch_size):
+        report["missing_chunks"] += 1
+        logger.error("Missing chunk: %s -> %s", chunk_id, location)
+
+    return report
+
+
+def run_reconcile_job():
+    '''Periodic entry point, configured through the environment'''
+    db = SessionLocal()
+    try:
+        report = reconcile(
+            db,
+            [volume.path for volume in all_volumes()],
+            dry_run=os.getenv("RECONCILE_APPLY", "false").lower() != "true",
+            grace_seconds=int(os.getenv("RECONCILE_GRACE_SECONDS", DEFAULT_GRACE_SECONDS)),
+        )
+        logger.info("Reconcile finished: %s", report)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile the storage directory with the files table")
+    parser.add_argument("--apply", action="store_true", help="quarantine orphan blobs instead of only reporting them")
+    parser.add_argument("--prune-dangling", action="store_true", help="with --apply, delete rows whose blob is missing")
+    parser.add_argument("--grace-seconds", type=int, default=DEFAULT_GRACE_SECONDS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--storage-location", action="append", help="directory to scan, all storage volumes by default")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        report = reconcile(
+            db,
+            args.storage_location or [volume.path for volume in all_volumes()],
+            dry_run=not args.apply,
+            prune_dangling=args.prune_dangling,
+            grace_seconds=args.grace_seconds,
+            batch_size=args.batch_size,
+        )
+    finally:
+        db.close()
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
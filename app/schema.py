@@ -13,3 +13,7 @@ class VerifyCodeRequest(BaseModel):
 class ShareFileRequest(BaseModel):
     file_id: str
     email: str
+
+class BulkShareFileRequest(BaseModel):
+    file_ids: list[str]
+    emails: list[str]
@@ -0,0 +1,228 @@
+'''Chunked, deduplicated and encrypted storage of file contents.
+
+Content is split with content-defined chunking so an edit only changes the chunks around it,
+every chunk is encrypted with Fernet and written once under <volume>/chunks/.
+'''
+import hashlib
+import hmac
+import logging
+import mimetypes
+import os
+import random
+import zlib
+from datetime import datetime, timedelta, UTC
+from cryptography.fernet import Fernet
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+from app.background import PeriodicWorker
+from app.cache import blob_cache
+from app.crud import touch_chunks, create_file_entry, delete_unreferenced_chunks
+from app.database import SessionLocal
+from app.models import User
+from app.volumes import choose_volume, chunk_path, read_file, write_file, volume_name_for_location
+from app.profiling import span
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+fernet = Fernet(os.environ["FILE_ENCRYPTION_KEY"])
+
+CHUNK_MIN_SIZE = int(os.getenv("CHUNK_MIN_SIZE", str(256 * 1024)))
+CHUNK_AVG_SIZE = int(os.getenv("CHUNK_AVG_SIZE", str(1024 * 1024)))
+CHUNK_MAX_SIZE = int(os.getenv("CHUNK_MAX_SIZE", str(4 * 1024 * 1024)))
+# Number of chunks looked up in the chunks table with one query while uploading
+CHUNK_LOOKUP_BATCH = int(os.getenv("CHUNK_LOOKUP_BATCH", "8"))
+FILE_VERSION_RETENTION = int(os.getenv("FILE_VERSION_RETENTION", "10"))
+CHUNK_GC_GRACE_SECONDS = int(os.getenv("CHUNK_GC_GRACE_SECONDS", str(60 * 60)))
+CHUNK_GC_INTERVAL_SECONDS = int(os.getenv("CHUNK_GC_INTERVAL_SECONDS", str(10 * 60)))
+CHUNK_GC_BATCH_SIZE = 500
+
+# Boundaries are where a hash of the last WINDOW_SIZE bytes matches a mask. Hashing every offset
+# in Python is too slow, so offsets are first filtered at C speed: every byte is mapped to one
+# pseudo random bit and only offsets ending a run of PREFILTER_BITS ones get hashed. Both steps
+# only look at the bytes before the offset, so boundaries move along with inserted/removed data.
+# The seed is fixed so boundaries are the same on every run.
+_rng = random.Random(0x6d696e69)
+_BIT_TABLE = bytes(_rng.getrandbits(1) for _ in range(256))
+PREFILTER_BITS = 10
+_PREFILTER_RUN = b"\x01" * PREFILTER_BITS
+WINDOW_SIZE = 48
+
+_chunk_id_key = hashlib.sha256(b"chunk-id:" + os.environ["FILE_ENCRYPTION_KEY"].encode()).digest()
+
+
+def _find_cut_point(data, min_size: int, avg_size: int, max_size: int) -> int:
+    '''Returns the length of the next chunk at the start of data'''
+    if len(data) <= min_size:
+        return len(data)
+    end = min(len(data), max_size)
+    # Normalized chunking: a stricter mask before avg_size and a looser one after it keeps
+    # chunk sizes close to the average
+    mask_bits = max(avg_size.bit_length() - 1 - PREFILTER_BITS, 2)
+    strict_mask = (1 << (mask_bits + 1)) - 1
+    loose_mask = (1 << (mask_bits - 1)) - 1
+
+    start = max(min_size - PREFILTER_BITS + 1, WINDOW_SIZE - PREFILTER_BITS)
+    flags = data[start:end].translate(_BIT_TABLE)
+    run = flags.find(_PREFILTER_RUN)
+    while run != -1:
+        cut = start + run + PREFILTER_BITS
+        mask = strict_mask if cut < avg_size else loose_mask
+        if not zlib.crc32(data[cut - WINDOW_SIZE:cut]) & mask:
+            return cut
+        run = flags.find(_PREFILTER_RUN, run + 1)
+    return end
+
+
+def iter_chunks(stream, min_size: int = CHUNK_MIN_SIZE, avg_size: int = CHUNK_AVG_SIZE, max_size: int = CHUNK_MAX_SIZE):
+    '''Splits the content of a binary file object into content-defined chunks'''
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            block = stream.read(max_size)
+            if not block:
+                eof = True
+            else:
+                buffer += block
+        if not buffer:
+            return
+        cut = _find_cut_point(buffer, min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def chunk_id(data: bytes) -> str:
+    '''Keyed hash of the chunk, so chunk names do not reveal hashes of the content'''
+    return hmac.new(_chunk_id_key, data, hashlib.sha256).hexdigest()
+
+
+def write_chunk(chunk_id: str, data: bytes) -> dict:
+    with span("crypto"):
+        encrypted = fernet.encrypt(data)
+    volume = choose_volume(chunk_id)
+    location = chunk_path(volume, chunk_id)
+    write_file(location, encrypted)
+    return {
+        "id": chunk_id,
+        "size": len(data),
+        "stored_size": len(encrypted),
+        "location": location,
+        "volume": volume.name
+    }
+
+
+def decode_blob(encrypted: bytes, compression: str = None) -> bytes:
+    with span("crypto"):
+        data = fernet.decrypt(encrypted)
+    if compression == "zlib":
+        data = zlib.decompress(data)
+    return data
+
+
+def encode_blob(data: bytes, compression: str = None) -> bytes:
+    if compression == "zlib":
+        data = zlib.compress(data)
+    with span("crypto"):
+        return fernet.encrypt(data)
+
+
+def read_blob(location: str, compression: str = None, cacheable: bool = True) -> bytes:
+    return blob_cache.get(location, lambda: decode_blob(read_file(location), compression), cacheable)
+
+
+def iter_chunk_contents(chunks: list, cacheable: bool = True):
+    '''Yields the plaintext of (location, compression) blobs in order, keeping them in the
+    download cache if cacheable'''
+    for location, compression in chunks:
+        yield read_blob(location, compression, cacheable)
+
+
+def guess_content_type(file_name: str, declared: str = None) -> str:
+    '''The MIME type the client sent, or one guessed from the file name'''
+    if declared and declared != "application/octet-stream":
+        return declared
+    return mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+
+
+def store_file_version(db: Session, user: User, file_name: str, stream, content_type: str = None, upload_job_id: str = None,
+                       upload_claim: str = None) -> dict:
+    '''Chunks the content, writes the chunks that are not stored yet and records the new version'''
+    hash_sha256 = hashlib.sha256()
+    file_size = 0
+    chunk_ids = []
+    new_chunks = []
+    stored_sizes = {}
+    pending = []
+
+    def write_pending():
+        stored_sizes.update(touch_chunks(list({pending_id for pending_id, _ in pending}), db))
+        for pending_id, data in pending:
+            if pending_id in stored_sizes:
+                continue
+            new_chunks.append(write_chunk(pending_id, data))
+            stored_sizes[pending_id] = new_chunks[-1]["stored_size"]
+        pending.clear()
+
+    for data in iter_chunks(stream):
+        with span("crypto"):
+            hash_sha256.update(data)
+            chunk_ids.append(chunk_id(data))
+        file_size += len(data)
+        pending.append((chunk_ids[-1], data))
+        if len(pending) >= CHUNK_LOOKUP_BATCH:
+            write_pending()
+    if pending:
+        write_pending()
+
+    checksum = hash_sha256.hexdigest()
+    file_id, version = create_file_entry(
+        db=db,
+        user=user,
+        file_name=file_name,
+        checksum=checksum,
+        file_size=file_size,
+        stored_size=sum(stored_sizes[chunk_id] for chunk_id in chunk_ids),
+        content_type=guess_content_type(file_name, content_type),
+        chunk_ids=chunk_ids,
+        new_chunks=new_chunks,
+        keep_versions=FILE_VERSION_RETENTION,
+        upload_job_id=upload_job_id,
+        upload_claim=upload_claim,
+        volume_of=volume_name_for_location
+    )
+    return {"file_id": file_id, "version": version, "checksum": checksum}
+
+
+def collect_garbage_chunks(db: Session, grace_seconds: int = CHUNK_GC_GRACE_SECONDS) -> int:
+    '''Removes chunks that no retained version references any more'''
+    removed = 0
+    older_than = datetime.now(UTC) - timedelta(seconds=grace_seconds)
+    while True:
+        # An upload that no longer finds a chunk writes it to a new path, so only the
+        # collected copies are removed here
+        locations = delete_unreferenced_chunks(older_than, CHUNK_GC_BATCH_SIZE, db)
+        blob_cache.invalidate(locations)
+        for location in locations:
+            try:
+                os.remove(location)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # The row is gone, reconciliation quarantines the blob later
+                logger.exception("Could not remove chunk %s", location)
+        removed += len(locations)
+        if len(locations) < CHUNK_GC_BATCH_SIZE:
+            return removed
+
+
+def run_chunk_gc_job():
+    db = SessionLocal()
+    try:
+        collect_garbage_chunks(db)
+    finally:
+        db.close()
+
+
+chunk_gc_worker = PeriodicWorker("chunk-gc", run_chunk_gc_job, CHUNK_GC_INTERVAL_SECONDS)
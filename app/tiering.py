@@ -0,0 +1,200 @@
+'''Hot/cold storage tiering.
+
+Downloads are counted in memory and written to the files table in batches. With
+COLD_STORAGE_LOCATION set, the tiering job moves blobs that no file accessed in the last
+TIERING_COLD_AFTER_DAYS days to the cold volume (recompressed with TIERING_COMPRESS=true), and
+moves them back to the regular volumes when a file using them is downloaded again. Demotion runs
+in the leader process only, promotions in the process that served the download. Moves copy the
+blob before repointing its row, so clients only notice the latency, which is reported as
+download_seconds by tier in /metrics/.
+'''
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, UTC
+from cryptography.fernet import InvalidToken
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+from app import volumes as storage_volumes
+from app.background import PeriodicWorker
+from app.cache import blob_cache
+from app.crud import record_file_accesses, get_cold_chunks, get_cold_blob_files, get_file_chunks_on_volume
+from app.database import SessionLocal
+from app.metrics import metrics
+from app.models import Chunk, File
+from app.storage import decode_blob, encode_blob, iter_chunk_contents
+from app.volumes import BlobMover, choose_volume, chunk_path, file_blob_path, is_cold, read_file
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+TIERING_COLD_AFTER_DAYS = float(os.getenv("TIERING_COLD_AFTER_DAYS", "7"))
+TIERING_INTERVAL_SECONDS = int(os.getenv("TIERING_INTERVAL_SECONDS", str(60 * 60)))
+TIERING_BATCH_SIZE = int(os.getenv("TIERING_BATCH_SIZE", "200"))
+TIERING_COMPRESS = os.getenv("TIERING_COMPRESS", "false").lower() == "true"
+# Compressed blobs are only kept when they are at most this fraction of the original
+TIERING_MAX_COMPRESSED_RATIO = 0.9
+ACCESS_FLUSH_INTERVAL_SECONDS = int(os.getenv("ACCESS_FLUSH_INTERVAL_SECONDS", "60"))
+
+
+class AccessStats:
+    '''Download counts and times, kept in memory until the next flush'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def record(self, file_id: str):
+        now = datetime.now(UTC)
+        with self._lock:
+            count, _ = self._pending.get(file_id, (0, None))
+            self._pending[file_id] = (count + 1, now)
+
+    def flush(self, db: Session) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            record_file_accesses(pending, db)
+        except Exception:
+            db.rollback()
+            # Keep the counts for the next flush
+            with self._lock:
+                for file_id, (count, accessed_at) in pending.items():
+                    newer_count, newer_accessed_at = self._pending.get(file_id, (0, accessed_at))
+                    self._pending[file_id] = (count + newer_count, newer_accessed_at)
+            raise
+        return len(pending)
+
+
+access_stats = AccessStats()
+
+
+def run_access_flush_job():
+    db = SessionLocal()
+    try:
+        access_stats.flush(db)
+    finally:
+        db.close()
+
+
+access_flush_worker = PeriodicWorker("access-flush", run_access_flush_job, ACCESS_FLUSH_INTERVAL_SECONDS)
+
+
+class Tiering(BlobMover):
+    '''Demotes cold blobs to the cold volume and promotes the blobs of downloaded files back'''
+
+    def __init__(self):
+        super().__init__()
+        self._promotions = set()
+        self._lock = threading.Lock()
+        # Demotion and promotion run in separate workers and share the blobs to unlink
+        self._run_lock = threading.Lock()
+
+    def request_promotion(self, file_id: str):
+        with self._lock:
+            self._promotions.add(file_id)
+        promotion_worker.wake()
+
+    def run(self):
+        if storage_volumes.cold_volume is None:
+            return
+        db = SessionLocal()
+        try:
+            with self._run_lock:
+                self.unlink_moved_blobs()
+                self.demote(db)
+        finally:
+            db.close()
+
+    def run_promotions(self):
+        if storage_volumes.cold_volume is None:
+            return
+        db = SessionLocal()
+        try:
+            with self._run_lock:
+                self.unlink_moved_blobs()
+                with self._lock:
+                    file_ids, self._promotions = self._promotions, set()
+                for file_id in file_ids:
+                    self.promote(db, file_id)
+        finally:
+            db.close()
+
+    def demote(self, db: Session, older_than: datetime = None, limit: int = TIERING_BATCH_SIZE) -> int:
+        cold = storage_volumes.cold_volume
+        if older_than is None:
+            older_than = datetime.now(UTC) - timedelta(days=TIERING_COLD_AFTER_DAYS)
+        moved = 0
+        for chunk_id, location, compression in get_cold_chunks(older_than, cold.name, limit, db):
+            moved += self.move_tier(db, Chunk, chunk_id, location, compression, chunk_path(cold, chunk_id),
+                                    "demote", volume=cold.name)
+        # Blobs of files uploaded before versioning
+        for file_id, location, compression in get_cold_blob_files(older_than, os.path.join(cold.path, ""), limit, db):
+            moved += self.move_tier(db, File, file_id, location, compression, file_blob_path(cold, file_id), "demote")
+        return moved
+
+    def promote(self, db: Session, file_id: str) -> int:
+        cold = storage_volumes.cold_volume
+        moved = 0
+        for chunk_id, location, compression in get_file_chunks_on_volume(file_id, cold.name, db):
+            target = choose_volume(chunk_id)
+            moved += self.move_tier(db, Chunk, chunk_id, location, compression, chunk_path(target, chunk_id),
+                                    "promote", volume=target.name)
+        file = db.query(File.location, File.compression).filter(File.id == file_id).first()
+        if file is not None and file.location is not None and cold.contains(file.location):
+            target = choose_volume(file_id)
+            moved += self.move_tier(db, File, file_id, file.location, file.compression, file_blob_path(target, file_id),
+                                    "promote")
+        return moved
+
+    def move_tier(self, db: Session, model, row_id: str, location: str, compression: str, new_location: str,
+                  direction: str, **values) -> bool:
+        '''Moves the blob, compressing it when demoted and decompressing it when promoted'''
+        compress = TIERING_COMPRESS and direction == "demote"
+        try:
+            if compress or compression is not None:
+                data = decode_blob(read_file(location), compression)
+                compression = None
+                if compress:
+                    packed = zlib.compress(data)
+                    if len(packed) <= len(data) * TIERING_MAX_COMPRESSED_RATIO:
+                        data, compression = packed, "zlib"
+                data = encode_blob(data)
+            else:
+                data = read_file(location)
+        except (OSError, InvalidToken, zlib.error):
+            # Missing or damaged blobs are reported by reconciliation, the batch goes on
+            logger.exception("Could not read %s for tiering", location)
+            metrics.inc("tiering_failed_moves", direction=direction)
+            return False
+        if model is Chunk:
+            values["stored_size"] = len(data)
+        if not self.move(db, model, row_id, location, new_location, data, compression=compression, **values):
+            return False
+        metrics.inc("tiering_moved_blobs", direction=direction)
+        metrics.inc("tiering_moved_bytes", len(data), direction=direction)
+        return True
+
+
+tiering = Tiering()
+tiering_worker = PeriodicWorker("tiering", tiering.run, TIERING_INTERVAL_SECONDS)
+promotion_worker = PeriodicWorker("tiering-promotion", tiering.run_promotions, TIERING_INTERVAL_SECONDS)
+
+
+def track_download(file_id: str, chunks: list, started: float, size: int = None):
+    '''Records the access, queues cold content for promotion and returns the content of the
+    (location, compression) blobs, timing the download by the tier it is read from. The blobs
+    go into the download cache if the file's size (None when unknown) is small enough'''
+    access_stats.record(file_id)
+    tier = "cold" if any(is_cold(location) for location, _ in chunks) else "hot"
+    if tier == "cold":
+        tiering.request_promotion(file_id)
+    return _timed_content(iter_chunk_contents(chunks, blob_cache.admits(size)), tier, started)
+
+
+def _timed_content(content, tier: str, started: float):
+    yield from content
+    metrics.observe("download_seconds", time.perf_counter() - started, tier=tier)
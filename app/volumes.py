@@ -0,0 +1,290 @@
+'''Storage volumes: placement of new blobs, timed blob I/O and the background rebalancer.
+
+Volumes are configured with STORAGE_VOLUMES="name=/path,name=/path" (default: STORAGE_LOCATION
+as the "default" volume). Volumes listed in STORAGE_DRAIN_VOLUMES get no new blobs and are
+emptied by the rebalancer. COLD_STORAGE_LOCATION adds the "cold" volume, which never gets new
+blobs and is only filled and emptied by tiering (app.tiering).
+'''
+import hashlib
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+from collections import deque
+from uuid import uuid4
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+from app.background import PeriodicWorker
+from app.cache import blob_cache
+from app.crud import relocate_blob
+from app.database import SessionLocal
+from app.metrics import metrics
+from app.models import Chunk, File
+from app.profiling import span
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# free_space: weighted by free bytes, hash: rendezvous hashing on the blob key
+STORAGE_PLACEMENT = os.getenv("STORAGE_PLACEMENT", "free_space")
+REBALANCE_INTERVAL_SECONDS = int(os.getenv("STORAGE_REBALANCE_INTERVAL_SECONDS", "600"))
+REBALANCE_BATCH_SIZE = int(os.getenv("STORAGE_REBALANCE_BATCH_SIZE", "200"))
+# Free space imbalance (fraction of capacity) the free_space rebalancer tolerates
+REBALANCE_THRESHOLD = float(os.getenv("STORAGE_REBALANCE_THRESHOLD", "0.1"))
+# Moved blobs stay at their old path for a while so downloads that already looked up
+# the old location can still read it
+MOVE_UNLINK_DELAY_SECONDS = int(os.getenv("STORAGE_MOVE_UNLINK_DELAY_SECONDS", "300"))
+DISK_USAGE_CACHE_SECONDS = 10
+
+
+class Volume:
+    def __init__(self, name: str, path: str, draining: bool = False):
+        self.name = name
+        self.path = path
+        self.draining = draining
+        self._prefix = os.path.join(path, "")
+
+    def contains(self, location: str) -> bool:
+        return location.startswith(self._prefix)
+
+
+def _load_volumes():
+    draining = {name.strip() for name in os.getenv("STORAGE_DRAIN_VOLUMES", "").split(",") if name.strip()}
+    configured = os.getenv("STORAGE_VOLUMES")
+    if configured:
+        entries = [entry.split("=", 1) for entry in configured.split(",") if entry.strip()]
+    else:
+        entries = [("default", os.environ["STORAGE_LOCATION"])]
+    return [Volume(name.strip(), path.strip(), name.strip() in draining) for name, path in entries]
+
+
+volumes = _load_volumes()
+cold_volume = Volume("cold", os.environ["COLD_STORAGE_LOCATION"]) if os.getenv("COLD_STORAGE_LOCATION") else None
+volumes_by_name = {volume.name: volume for volume in volumes}
+if cold_volume is not None:
+    volumes_by_name[cold_volume.name] = cold_volume
+
+
+def all_volumes() -> list:
+    '''The volumes taking new blobs plus the cold volume'''
+    return volumes + [cold_volume] if cold_volume is not None else list(volumes)
+
+_disk_usage = {}
+_disk_usage_lock = threading.Lock()
+
+
+def disk_usage(volume: Volume):
+    '''shutil.disk_usage of the volume, cached for a few seconds'''
+    now = time.monotonic()
+    with _disk_usage_lock:
+        cached = _disk_usage.get(volume.name)
+        if cached and now - cached[0] < DISK_USAGE_CACHE_SECONDS:
+            return cached[1]
+    os.makedirs(volume.path, exist_ok=True)
+    usage = shutil.disk_usage(volume.path)
+    with _disk_usage_lock:
+        _disk_usage[volume.name] = (now, usage)
+    return usage
+
+
+def _rendezvous(key: str, candidates: list) -> Volume:
+    return max(candidates, key=lambda volume: hashlib.sha256(f"{volume.name}:{key}".encode()).digest())
+
+
+def choose_volume(key: str) -> Volume:
+    '''Picks the volume for a new blob'''
+    candidates = [volume for volume in volumes if not volume.draining] or volumes
+    if len(candidates) == 1:
+        return candidates[0]
+    if STORAGE_PLACEMENT == "hash":
+        return _rendezvous(key, candidates)
+    weights = [disk_usage(volume).free for volume in candidates]
+    if not any(weights):
+        return _rendezvous(key, candidates)
+    return random.choices(candidates, weights)[0]
+
+
+def volume_name_for_location(location: str) -> str:
+    for volume in all_volumes():
+        if volume.contains(location):
+            return volume.name
+    return "unknown"
+
+
+def is_cold(location: str) -> bool:
+    return cold_volume is not None and cold_volume.contains(location)
+
+
+def chunk_path(volume: Volume, chunk_id: str) -> str:
+    '''A new path for a blob of the chunk. Every write gets its own path, so removing a collected or
+    moved blob never removes a newer copy of the same chunk'''
+    return os.path.join(volume.path, "chunks", chunk_id[:2], f"{chunk_id}.{uuid4().hex[:12]}")
+
+
+def file_blob_path(volume: Volume, file_id: str) -> str:
+    '''A new path for the blob of a file uploaded before versioning, unique like chunk_path'''
+    return os.path.join(volume.path, f"{file_id}.{uuid4().hex[:12]}")
+
+
+def read_file(location: str) -> bytes:
+    start = time.perf_counter()
+    with span("io"), open(location, 'rb') as f:
+        data = f.read()
+    volume = volume_name_for_location(location)
+    metrics.inc("storage_read_bytes", len(data), volume=volume)
+    metrics.observe("storage_read_seconds", time.perf_counter() - start, volume=volume)
+    return data
+
+
+def write_file(path: str, data: bytes):
+    '''Writes the blob atomically and durably, readers never see a partially written file'''
+    start = time.perf_counter()
+    with span("io"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as out_file:
+            out_file.write(data)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, path)
+    volume = volume_name_for_location(path)
+    metrics.inc("storage_write_bytes", len(data), volume=volume)
+    metrics.observe("storage_write_seconds", time.perf_counter() - start, volume=volume)
+
+
+def _volume_gauges():
+    gauges = []
+    for volume in all_volumes():
+        try:
+            gauges.append(({"volume": volume.name}, disk_usage(volume).free))
+        except OSError:
+            gauges.append(({"volume": volume.name}, None))
+    return gauges
+
+
+metrics.register_gauge("storage_volume_free_bytes", _volume_gauges)
+
+
+class BlobMover:
+    '''Moves blobs to another location and points their row at the new copy'''
+
+    def __init__(self):
+        self._pending_unlinks = deque()
+
+    def unlink_moved_blobs(self, delay: float = MOVE_UNLINK_DELAY_SECONDS):
+        while self._pending_unlinks and time.monotonic() - self._pending_unlinks[0][0] >= delay:
+            _, location = self._pending_unlinks.popleft()
+            blob_cache.invalidate([location])
+            try:
+                os.remove(location)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.exception("Could not remove moved blob %s", location)
+
+    def move(self, db: Session, model, row_id: str, location: str, new_location: str, data: bytes = None, **values) -> bool:
+        '''Copies the blob (or writes data in its place), then points the row at the copy. A crash
+        in between leaves an unreferenced copy (or original) behind, which reconciliation picks up.
+        new_location has to be a path no blob had before (chunk_path, file_blob_path): the old
+        location is removed later, and must not be where the blob lives by then'''
+        write_file(new_location, read_file(location) if data is None else data)
+        if not relocate_blob(model, row_id, location, new_location, db, **values):
+            # Deleted or moved by someone else in the meantime, maybe by another process promoting
+            # the same file. The copy is at a path of its own, so it is ours to remove
+            os.remove(new_location)
+            return False
+        self._pending_unlinks.append((time.monotonic(), location))
+        metrics.inc("storage_moved_blobs", source=volume_name_for_location(location), target=volume_name_for_location(new_location))
+        return True
+
+
+class Rebalancer(BlobMover):
+    '''Moves blobs off draining volumes and evens out the others, a batch per run'''
+
+    def __init__(self):
+        super().__init__()
+        self._hash_cursor = ""
+
+    def run(self):
+        db = SessionLocal()
+        try:
+            self.unlink_moved_blobs()
+            self.rebalance(db)
+        finally:
+            db.close()
+
+    def move_chunk(self, db: Session, chunk_id: str, location: str, target: Volume) -> bool:
+        return self.move(db, Chunk, chunk_id, location, chunk_path(target, chunk_id), volume=target.name)
+
+    def rebalance(self, db: Session, limit: int = REBALANCE_BATCH_SIZE) -> int:
+        draining = [volume for volume in volumes if volume.draining]
+        if draining:
+            return self.drain(db, draining, limit)
+        if len(volumes) < 2:
+            return 0
+        if STORAGE_PLACEMENT == "hash":
+            return self.rehash(db, limit)
+        return self.even_out(db, limit)
+
+    def drain(self, db: Session, draining: list, limit: int) -> int:
+        moved = 0
+        chunks = db.query(Chunk.id, Chunk.location, Chunk.volume).filter(
+            Chunk.volume.in_([volume.name for volume in draining])
+        ).limit(limit).all()
+        for chunk_id, location, volume in chunks:
+            target = choose_volume(chunk_id)
+            if target.name != volume:  # every volume is draining otherwise
+                moved += self.move_chunk(db, chunk_id, location, target)
+        # Blobs of files uploaded before versioning
+        for volume in draining:
+            files = db.query(File.id, File.location).filter(
+                File.location.like(os.path.join(volume.path, "") + "%")
+            ).limit(limit).all()
+            for file_id, location in files:
+                target = choose_volume(file_id)
+                if volume.contains(location) and target is not volume:
+                    moved += self.move(db, File, file_id, location, file_blob_path(target, file_id))
+        return moved
+
+    def rehash(self, db: Session, limit: int) -> int:
+        '''Walks the chunks in pages across runs and moves the ones hashed to another volume'''
+        chunks = (
+            db.query(Chunk.id, Chunk.location, Chunk.volume)
+            .filter(Chunk.id > self._hash_cursor, Chunk.volume.in_([volume.name for volume in volumes]))
+            .order_by(Chunk.id)
+            .limit(limit * 10)
+            .all()
+        )
+        if not chunks:
+            # Start the next pass from the beginning
+            self._hash_cursor = ""
+        moved = 0
+        for chunk_id, location, volume in chunks:
+            # The rest of the page is examined by the next run
+            self._hash_cursor = chunk_id
+            target = _rendezvous(chunk_id, volumes)
+            if target.name != volume:
+                moved += self.move_chunk(db, chunk_id, location, target)
+                if moved >= limit:
+                    break
+        return moved
+
+    def even_out(self, db: Session, limit: int) -> int:
+        '''Moves chunks from the fullest volume to the emptiest one'''
+        free = {volume.name: disk_usage(volume).free / disk_usage(volume).total for volume in volumes}
+        fullest = min(volumes, key=lambda volume: free[volume.name])
+        emptiest = max(volumes, key=lambda volume: free[volume.name])
+        if free[emptiest.name] - free[fullest.name] <= REBALANCE_THRESHOLD:
+            return 0
+        moved = 0
+        chunks = db.query(Chunk.id, Chunk.location).filter(Chunk.volume == fullest.name).limit(limit).all()
+        for chunk_id, location in chunks:
+            moved += self.move_chunk(db, chunk_id, location, emptiest)
+        return moved
+
+
+rebalancer = Rebalancer()
+rebalance_worker = PeriodicWorker("rebalance", rebalancer.run, REBALANCE_INTERVAL_SECONDS)
@@ -0,0 +1,83 @@
+'''Compares many concurrent downloads of one file reading every chunk themselves with
+downloads going through the shared blob cache (coalescing only, then with the LRU cache on).
+
+    DATABASE_URL=sqlite:///./bench.db STORAGE_LOCATION=./bench-data FILE_ENCRYPTION_KEY=... \
+        python -m benchmarks.download_fanout --size-mb 16 --clients 32
+'''
+import argparse
+import os
+import threading
+import time
+from io import BytesIO
+from app.cache import blob_cache
+from app.crud import get_version_chunks
+from app.database import Base, SessionLocal, engine
+from app.metrics import metrics
+from app.models import File, User
+from app.storage import decode_blob, iter_chunk_contents, store_file_version
+from app.volumes import read_file
+
+
+def read_uncached(chunks):
+    for location, compression in chunks:
+        yield decode_blob(read_file(location), compression)
+
+
+def read_bytes() -> int:
+    return sum(counter["value"] for counter in metrics.snapshot()["counters"].get("storage_read_bytes", []))
+
+
+def fan_out(name: str, read, chunks: list, clients: int, rounds: int):
+    barrier = threading.Barrier(clients)
+
+    def download():
+        for _ in range(rounds):
+            barrier.wait()
+            for _ in read(chunks):
+                pass
+
+    threads = [threading.Thread(target=download) for _ in range(clients)]
+    bytes_before = read_bytes()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    downloads = clients * rounds
+    print(
+        f"{name:>10}: {downloads / elapsed:7.1f} downloads/s, "
+        f"{(read_bytes() - bytes_before) / downloads / 2**20:6.2f} MiB read and "
+        f"{(time.process_time() - cpu_before) / downloads * 1000:6.1f} ms CPU per download"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user = User(email=f"bench-{os.getpid()}-{time.time()}@example.com")
+        db.add(user)
+        db.commit()
+        stored = store_file_version(db, user, "popular.bin", BytesIO(os.urandom(args.size_mb * 2**20)))
+        file = db.query(File).filter(File.id == stored["file_id"]).first()
+        chunks = get_version_chunks(file, None, db)
+    finally:
+        db.close()
+
+    fan_out("uncached", read_uncached, chunks, args.clients, args.rounds)
+    blob_cache.max_bytes = 0
+    fan_out("coalesced", iter_chunk_contents, chunks, args.clients, args.rounds)
+    blob_cache.max_bytes = 4 * args.size_mb * 2**20
+    fan_out("lru cache", iter_chunk_contents, chunks, args.clients, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+'''Measures how long the app takes to import and to become ready, and how GET /file/list/
+throughput grows with the number of uvicorn worker processes.
+
+Runs against DATABASE_URL (use a scratch database, the tables are created and rows are added):
+    DATABASE_URL=sqlite:///./bench.db STORAGE_LOCATION=./bench-data FILE_ENCRYPTION_KEY=... \
+        python -m benchmarks.serve_scaling --workers 1 2 4 --clients 16
+Load is generated by client processes on the same host, so leave cores for them.
+'''
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from app.crud import create_user_and_otp, verify_code_and_generate_session
+from app.database import Base, SessionLocal, engine
+from app.models import File, User
+
+PORT = 8765
+
+
+def create_fixtures(files: int) -> str:
+    '''Returns a session token of a user owning `files` files'''
+    db = SessionLocal()
+    try:
+        email = f"serve-{os.getpid()}-{time.time()}@example.com"
+        create_user_and_otp(email, "bench", "bench0", db)
+        session_id = verify_code_and_generate_session("bench0", "bench", db)
+        user = db.query(User).filter(User.email == email).first()
+        db.add_all(File(file_name=f"bench-{i}", owner_user_id=user.id, checksum="0") for i in range(files))
+        db.commit()
+        return session_id
+    finally:
+        db.close()
+
+
+def import_seconds() -> float:
+    code = "import time; started = time.perf_counter(); import app.main; print(time.perf_counter() - started)"
+    return float(subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout)
+
+
+def wait_until_ready(server: subprocess.Popen, timeout: float = 60) -> float:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited during startup")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+            connection.request("GET", "/ready/")
+            if connection.getresponse().status == 200:
+                return time.perf_counter() - started
+        except OSError:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError("The server did not become ready")
+
+
+def client(args) -> int:
+    session_id, seconds = args
+    connection = http.client.HTTPConnection("127.0.0.1", PORT)
+    headers = {"Authorization": f"Bearer {session_id}"}
+    requests = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        connection.request("GET", "/file/list/", headers=headers)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"GET /file/list/ returned {response.status}")
+        requests += 1
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--files", type=int, default=50)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    session_id = create_fixtures(args.files)
+    print(f"import app.main: {import_seconds():.2f}s, {os.cpu_count()} cores")
+
+    baseline = None
+    for workers in args.workers:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(PORT), "--workers", str(workers),
+             "--log-level", "warning"]
+        )
+        try:
+            ready = wait_until_ready(server)
+            with multiprocessing.Pool(args.clients) as pool:
+                started = time.perf_counter()
+                requests = sum(pool.map(client, [(session_id, args.seconds)] * args.clients))
+                elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+        throughput = requests / elapsed
+        baseline = baseline or throughput / workers
+        print(
+            f"{workers:>2} workers: ready in {ready:5.2f}s, {throughput:7.1f} requests/s, "
+            f"{throughput / workers:7.1f} per worker ({throughput / workers / baseline:4.0%} of one worker's)"
+        )
+
+
+if __name__ == "__main__":
+    main()
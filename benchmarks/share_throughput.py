@@ -0,0 +1,60 @@
+'''Compares sharing files one pair at a time with add_share_files_bulk.
+
+Runs against DATABASE_URL (use a scratch database, the tables are created and rows are added):
+    DATABASE_URL=sqlite:///./bench.db python -m benchmarks.share_throughput --files 200 --users 50
+'''
+import argparse
+import time
+from uuid import uuid4
+from app.crud import add_share_file, add_share_files_bulk, is_owner
+from app.database import Base, SessionLocal, engine
+from app.models import File, User
+
+
+def create_fixtures(db, files: int, users: int):
+    run = uuid4().hex[:8]
+    owner = User(email=f"owner-{run}@example.com")
+    db.add(owner)
+    db.flush()
+    file_ids = []
+    for i in range(files):
+        file = File(file_name=f"bench-{i}", owner_user_id=owner.id, checksum="0")
+        db.add(file)
+        db.flush()
+        file_ids.append(file.id)
+    emails = [f"member-{run}-{i}@example.com" for i in range(users)]
+    db.add_all(User(email=email) for email in emails)
+    db.commit()
+    return owner.id, file_ids, emails
+
+
+def share_per_item(db, owner_id: str, file_ids: list, emails: list):
+    '''What a client does today: one /file/share/ call per pair'''
+    for file_id in file_ids:
+        for email in emails:
+            if is_owner(file_id, owner_id, db):
+                add_share_file(file_id, email, db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--users", type=int, default=50)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        pairs = args.files * args.users
+        for name, share in (("per-item", share_per_item), ("bulk", add_share_files_bulk)):
+            owner_id, file_ids, emails = create_fixtures(db, args.files, args.users)
+            start = time.perf_counter()
+            share(owner_id=owner_id, file_ids=file_ids, emails=emails, db=db)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>8}: {pairs} shares in {elapsed:.2f}s ({pairs / elapsed:,.0f} shares/s)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+#!/bin/sh
+set -e
+
+# Migrate once, before any worker process starts
+python -m app.migrate
+
+# One worker process per core unless WEB_CONCURRENCY says otherwise
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 \
+    --workers "${WEB_CONCURRENCY:-$(nproc)}" \
+    --timeout-graceful-shutdown "${GRACEFUL_SHUTDOWN_SECONDS:-30}" \
+    "$@"
@@ -1,4 +1,5 @@
 import shutil
+from io import BytesIO
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
@@ -99,3 +100,700 @@ def test_file_upload_download(setup_database):
     headers=headers
     )
     assert download_resp.status_code == 403
+
+def test_reconcile_orphans(setup_database, tmp_path):
+    import os
+    import time
+    from uuid import uuid4
+    from app.models import File
+    from app.reconcile import reconcile, QUARANTINE_DIR
+
+    root = str(tmp_path)
+    known = os.path.join(root, "known")
+    orphan = os.path.join(root, "orphan")
+    fresh = os.path.join(root, "fresh")
+    for path in (known, orphan, fresh):
+        with open(path, "wb") as f:
+            f.write(b"x")
+    old = time.time() - 2 * 60 * 60
+    os.utime(known, (old, old))
+    os.utime(orphan, (old, old))
+
+    db = TestingSessionLocal()
+    dangling_id = str(uuid4())
+    db.add(File(id=str(uuid4()), checksum="c", location=known, file_name="known"))
+    db.add(File(id=dangling_id, checksum="c", location=os.path.join(root, "missing"), file_name="missing"))
+    db.commit()
+
+    report = reconcile(db, [root], dry_run=True)
+    assert report["orphan_blobs"] == 1
+    assert report["dangling_files"] == 1
+    assert os.path.exists(orphan)
+
+    report = reconcile(db, [root], dry_run=False, prune_dangling=True)
+    assert report["quarantined"] == 1
+    assert report["pruned_files"] == 1
+    assert not os.path.exists(orphan)
+    assert os.path.exists(os.path.join(root, QUARANTINE_DIR, "orphan"))
+    assert os.path.exists(fresh)
+    assert db.query(File).filter(File.id == dangling_id).first() is None
+    db.close()
+
+def test_delete_is_tombstoned_then_purged(setup_database):
+    import os
+    from app.crud import get_version_chunks
+    from app.deletion import purge_deleted_files
+    from app.models import File, FileVersion, User
+    from app.storage import collect_garbage_chunks
+
+    session_token = test_auth_code_flow(setup_database)
+    headers = {"Authorization": f"Bearer {session_token}"}
+    files = {"in_file": ("purge.txt", b"purge me", "text/plain")}
+    file_id = client.post("/file/upload/", files=files, headers=headers).json()["file_id"]
+    storage_before = client.get("/user/storage/", headers=headers).json()["current_storage_bytes"]
+
+    assert client.delete("/file/delete/", params={"file_id": file_id}, headers=headers).status_code == 200
+    assert all(f["id"] != file_id for f in client.get("/file/list/", headers=headers).json()["owned_files"])
+
+    db = TestingSessionLocal()
+    file = db.query(File).filter(File.id == file_id).first()
+    assert file.deleted_at is not None
+    owner_id = file.owner_user_id
+    [(location, _)] = get_version_chunks(file, None, db)
+    assert os.path.exists(location)
+
+    assert purge_deleted_files(db) >= 1
+    assert db.query(File).filter(File.id == file_id).first() is None
+    assert db.query(FileVersion).filter(FileVersion.file_id == file_id).first() is None
+    user = db.query(User).filter(User.id == owner_id).first()
+    assert user.current_storage <= storage_before - len(b"purge me")
+
+    assert collect_garbage_chunks(db, grace_seconds=-60) >= 1
+    assert not os.path.exists(location)
+    db.close()
+
+def test_chunk_gc_keeps_a_chunk_uploaded_again(setup_database):
+    import os
+    from datetime import datetime, timedelta, UTC
+    from app.crud import delete_unreferenced_chunks
+    from app.deletion import purge_deleted_files
+
+    headers = login("gc-race@example.com")
+    files = {"in_file": ("gc.txt", b"collected then uploaded again", "text/plain")}
+    file_id = client.post("/file/upload/", files=files, headers=headers).json()["file_id"]
+    client.delete("/file/delete/", params={"file_id": file_id}, headers=headers)
+    db = TestingSessionLocal()
+    purge_deleted_files(db)
+
+    # The rows are gone but the blobs not yet when the same content is uploaded again
+    collected = delete_unreferenced_chunks(datetime.now(UTC) + timedelta(minutes=1), 500, db)
+    assert collected
+    file_id = client.post("/file/upload/", files=files, headers=headers).json()["file_id"]
+    for location in collected:
+        os.remove(location)
+    resp = client.get("/file/download/", params={"file_id": file_id}, headers=headers)
+    assert resp.content == b"collected then uploaded again"
+    db.close()
+
+def test_purge_legacy_files(setup_database, tmp_path, monkeypatch):
+    from datetime import datetime, timedelta, UTC
+    from app import deletion
+    from app.models import File, User
+
+    db = TestingSessionLocal()
+    deletion.purge_deleted_files(db)
+    owner = User(email="legacy-purge@example.com", current_storage=1000)
+    db.add(owner)
+    db.flush()
+    deleted_at = datetime.now(UTC) - timedelta(hours=1)
+    stuck_blob, legacy_blob = tmp_path / "stuck", tmp_path / "legacy"
+    stuck_blob.write_bytes(b"x" * 150)
+    legacy_blob.write_bytes(b"x" * 150)
+    # Files uploaded before versioning keep their blob in location
+    stuck = File(file_name="stuck.txt", owner_user_id=owner.id, checksum="0", location=str(stuck_blob),
+                 size=100, deleted_at=deleted_at)
+    legacy = File(file_name="legacy.txt", owner_user_id=owner.id, checksum="0", location=str(legacy_blob),
+                  size=100, deleted_at=deleted_at + timedelta(minutes=1))
+    db.add_all([stuck, legacy])
+    db.commit()
+    stuck_id, legacy_id, owner_id = stuck.id, legacy.id, owner.id
+
+    unlink_blob = deletion.unlink_blob
+    monkeypatch.setattr(deletion, "unlink_blob", lambda location: None if location == str(stuck_blob) else unlink_blob(location))
+    # The file that cannot be removed goes to the back of the queue instead of blocking it
+    assert deletion.purge_deleted_files(db, batch_size=1) == 0
+    db.expire_all()
+    assert db.query(File).filter(File.id == stuck_id).first().purge_attempts == 1
+    assert deletion.purge_deleted_files(db, batch_size=1) == 1
+    assert db.query(File).filter(File.id == legacy_id).first() is None
+    assert not legacy_blob.exists()
+    # Given back the plaintext size it was charged, not the size of the blob
+    assert db.query(User).filter(User.id == owner_id).first().current_storage == 900
+    db.close()
+
+def test_file_versions_share_chunks(setup_database):
+    import os
+    from app.models import Chunk
+    from app.storage import iter_chunks
+
+    headers = login("versions@example.com")
+    original = os.urandom(3 * 1024 * 1024)
+    edited = original[:1500000] + b"an edit in the middle" + original[1500000:]
+
+    first = client.post("/file/upload/", files={"in_file": ("big.bin", original)}, headers=headers).json()
+    db = TestingSessionLocal()
+    chunks_before = db.query(Chunk).count()
+    second = client.post("/file/upload/", files={"in_file": ("big.bin", edited)}, headers=headers).json()
+    new_chunks = db.query(Chunk).count() - chunks_before
+    db.close()
+
+    assert second["file_id"] == first["file_id"]
+    assert (first["version"], second["version"]) == (1, 2)
+    assert 0 < new_chunks < len(list(iter_chunks(BytesIO(edited))))
+
+    versions = client.get("/file/versions/", params={"file_id": first["file_id"]}, headers=headers).json()["versions"]
+    assert [v["version"] for v in versions] == [2, 1]
+    latest = client.get("/file/download/", params={"file_id": first["file_id"]}, headers=headers)
+    assert latest.content == edited
+    old = client.get("/file/download/", params={"file_id": first["file_id"], "version": 1}, headers=headers)
+    assert old.content == original
+
+def test_concurrent_first_upload_adds_a_version(setup_database, monkeypatch):
+    from app import crud
+
+    headers = login("racing@example.com")
+    first = client.post("/file/upload/", files={"in_file": ("race.txt", b"one")}, headers=headers).json()
+
+    # The lookup ran before the other upload committed the file
+    lookups = []
+    get_live_file_for_update = crud.get_live_file_for_update
+    def raced(user_id, file_name, db):
+        lookups.append(file_name)
+        return None if len(lookups) == 1 else get_live_file_for_update(user_id, file_name, db)
+    monkeypatch.setattr(crud, "get_live_file_for_update", raced)
+
+    second = client.post("/file/upload/", files={"in_file": ("race.txt", b"two")}, headers=headers).json()
+    assert len(lookups) == 2
+    assert (second["file_id"], second["version"]) == (first["file_id"], 2)
+    assert client.get("/file/download/", params={"file_id": first["file_id"]}, headers=headers).content == b"two"
+
+def test_upload_adds_a_version_to_a_legacy_file(setup_database):
+    import os
+    from app.models import File, User
+    from app.storage import encode_blob
+    from app.volumes import volumes, write_file
+
+    headers = login("legacy-upload@example.com")
+    db = TestingSessionLocal()
+    owner = db.query(User).filter(User.email == "legacy-upload@example.com").first()
+    # Uploaded before versioning: one encrypted blob in the files row
+    location = os.path.join(volumes[0].path, "legacy-upload.txt")
+    write_file(location, encode_blob(b"before versioning"))
+    legacy = File(file_name="notes.txt", owner_user_id=owner.id, checksum="0", location=location, size=17, stored_size=17)
+    db.add(legacy)
+    db.commit()
+
+    upload = client.post("/file/upload/", files={"in_file": ("notes.txt", b"after versioning")}, headers=headers).json()
+    assert (upload["file_id"], upload["version"]) == (legacy.id, 2)
+    assert len([f for f in client.get("/file/list/", headers=headers).json()["owned_files"] if f["file_name"] == "notes.txt"]) == 1
+    old = client.get("/file/download/", params={"file_id": legacy.id, "version": 1}, headers=headers)
+    assert old.content == b"before versioning"
+    assert client.get("/file/download/", params={"file_id": legacy.id}, headers=headers).content == b"after versioning"
+    db.close()
+
+def login(email, device_id="device-123"):
+    code = client.post("/auth/code/request", json={"email": email, "device_id": device_id}).json()["code"]
+    session_token = client.post("/auth/code/verify", json={"code": code, "device_id": device_id}).json()["session_token"]
+    return {"Authorization": f"Bearer {session_token}"}
+
+def test_change_feed(setup_database):
+    from datetime import datetime, timedelta, UTC
+    from app.crud import compact_change_log
+
+    owner = login("owner-changes@example.com")
+    recipient = login("recipient-changes@example.com")
+    cursor = client.get("/file/changes/", headers=recipient).json()["cursor"]
+
+    files = {"in_file": ("feed.txt", b"feed", "text/plain")}
+    file_id = client.post("/file/upload/", files=files, headers=owner).json()["file_id"]
+    share = {"file_id": file_id, "email": "recipient-changes@example.com"}
+    assert client.post("/file/share/", json=share, headers=owner).status_code == 200
+
+    resp = client.get("/file/changes/", params={"cursor": cursor}, headers=recipient).json()
+    assert resp["reset"] is False
+    assert resp["changes"] == [{"file_id": file_id, "action": "share", "file": resp["changes"][0]["file"]}]
+    assert resp["changes"][0]["file"]["file_name"] == "feed.txt"
+    cursor = resp["cursor"]
+
+    assert client.get("/file/changes/", params={"cursor": cursor}, headers=recipient).json()["changes"] == []
+
+    # A new version of a shared file shows up for the recipient as well
+    files = {"in_file": ("feed.txt", b"feed v2", "text/plain")}
+    assert client.post("/file/upload/", files=files, headers=owner).json()["file_id"] == file_id
+    resp = client.get("/file/changes/", params={"cursor": cursor}, headers=recipient).json()
+    assert [(change["file_id"], change["action"]) for change in resp["changes"]] == [(file_id, "upload")]
+    cursor = resp["cursor"]
+
+    assert client.delete("/file/delete/", params={"file_id": file_id}, headers=owner).status_code == 200
+    resp = client.get("/file/changes/", params={"cursor": cursor}, headers=recipient).json()
+    assert resp["changes"] == [{"file_id": file_id, "action": "unshare"}]
+
+    owner_changes = client.get("/file/changes/", headers=owner).json()["changes"]
+    assert {"file_id": file_id, "action": "delete"} in owner_changes
+
+    db = TestingSessionLocal()
+    assert compact_change_log(datetime.now(UTC) + timedelta(seconds=1), db) > 0
+    db.close()
+    resp = client.get("/file/changes/", params={"cursor": cursor}, headers=recipient).json()
+    assert resp["reset"] is True
+    assert client.get("/file/changes/", params={"cursor": resp["cursor"]}, headers=recipient).json()["reset"] is False
+
+def test_change_cursor_ahead_of_a_lagging_replica(setup_database, tmp_path):
+    from app.crud import get_changes_since
+    from app.models import User
+
+    headers = login("lagging-feed@example.com")
+    client.post("/file/upload/", files={"in_file": ("first.txt", b"first")}, headers=headers)
+    # The replica stopped replaying here
+    shutil.copy("test.db", tmp_path / "replica.db")
+    client.post("/file/upload/", files={"in_file": ("second.txt", b"second")}, headers=headers)
+    cursor = client.get("/file/changes/", params={"cursor": 0}, headers=headers).json()["cursor"]
+
+    replica = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'replica.db'}"))()
+    user_id = replica.query(User.id).filter(User.email == "lagging-feed@example.com").scalar()
+    assert get_changes_since(user_id, cursor, replica, 100) == {"reset": False, "cursor": cursor, "has_more": False, "changes": []}
+    replica.close()
+
+def test_rebalancer_drains_volume(setup_database, tmp_path, monkeypatch):
+    import os
+    from app import volumes as storage_volumes
+    from app.models import Chunk
+    from app.volumes import Volume, Rebalancer, chunk_path
+
+    old = Volume("old", str(tmp_path / "old"), draining=True)
+    new = Volume("new", str(tmp_path / "new"))
+    monkeypatch.setattr(storage_volumes, "volumes", [old, new])
+
+    location = chunk_path(old, "ab" * 32)
+    storage_volumes.write_file(location, b"encrypted chunk")
+    db = TestingSessionLocal()
+    db.add(Chunk(id="ab" * 32, size=1, stored_size=15, location=location, volume="old"))
+    db.commit()
+
+    rebalancer = Rebalancer()
+    assert rebalancer.rebalance(db) == 1
+    chunk = db.query(Chunk).filter(Chunk.id == "ab" * 32).first()
+    assert chunk.volume == "new" and new.contains(chunk.location)
+    assert storage_volumes.read_file(chunk.location) == b"encrypted chunk"
+
+    # The old copy stays readable for downloads in flight until the unlink delay passed
+    assert os.path.exists(location)
+    rebalancer.unlink_moved_blobs(delay=0)
+    assert not os.path.exists(location)
+    db.delete(chunk)
+    db.commit()
+    db.close()
+
+def test_rehash_resumes_after_the_last_examined_chunk(setup_database, tmp_path, monkeypatch):
+    from app import volumes as storage_volumes
+    from app.models import Chunk
+    from app.volumes import Volume, Rebalancer, chunk_path, _rendezvous
+
+    first, second = Volume("first", str(tmp_path / "first")), Volume("second", str(tmp_path / "second"))
+    monkeypatch.setattr(storage_volumes, "volumes", [first, second])
+    # Chunks that belong on the second volume but sit on the first
+    chunk_ids = sorted(chunk_id for chunk_id in (f"{i:02x}" * 32 for i in range(40)) if _rendezvous(chunk_id, [first, second]) is second)[:3]
+    db = TestingSessionLocal()
+    for chunk_id in chunk_ids:
+        location = chunk_path(first, chunk_id)
+        storage_volumes.write_file(location, b"encrypted chunk")
+        db.add(Chunk(id=chunk_id, size=1, stored_size=15, location=location, volume="first"))
+    db.commit()
+
+    rebalancer = Rebalancer()
+    assert [rebalancer.rehash(db, limit=1) for _ in chunk_ids] == [1, 1, 1]
+    assert {volume for (volume,) in db.query(Chunk.volume).filter(Chunk.id.in_(chunk_ids))} == {"second"}
+    db.query(Chunk).filter(Chunk.id.in_(chunk_ids)).delete(synchronize_session=False)
+    db.commit()
+    db.close()
+
+def test_profiling_middleware(monkeypatch):
+    import time
+    from collections import deque
+    from fastapi import APIRouter, FastAPI
+    from app import profiling
+
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0)
+    monkeypatch.setattr(profiling, "PROFILE_SLOW_MS", 0)
+    monkeypatch.setattr(profiling, "profiles", deque(maxlen=5))
+
+    router = APIRouter(route_class=profiling.ProfiledRoute)
+
+    @router.get("/work")
+    def work():
+        with profiling.span("db"):
+            time.sleep(0.03)
+        with profiling.span("crypto"):
+            time.sleep(0.01)
+        return {"ok": True}
+
+    profiled_app = FastAPI(default_response_class=profiling.ProfiledJSONResponse)
+    profiled_app.include_router(router)
+    profiled_app.add_middleware(profiling.ProfilingMiddleware)
+    profiled_client = TestClient(profiled_app)
+
+    assert "server-timing" not in profiled_client.get("/work").headers
+    assert len(profiling.profiles) == 0
+
+    resp = profiled_client.get("/work", headers={"X-Profile": "admin-secret"})
+    assert resp.json() == {"ok": True}
+    assert "db;dur=" in resp.headers["server-timing"]
+    [profile] = profiling.profiles
+    assert profile.id == resp.headers["x-profile-id"]
+    details = profile.to_dict(with_stacks=True)
+    assert details["breakdown"]["db"]["ms"] >= 30
+    assert details["breakdown"]["serialization"]["count"] == 1
+    assert any("work" in stack["stack"] for stack in details["stacks"])
+
+    assert client.get("/admin/profiles/").status_code == 403
+
+def test_bulk_share(setup_database):
+    owner = login("bulk-owner@example.com")
+    login("bulk-a@example.com")
+    recipient = login("bulk-b@example.com")
+    file_ids = [
+        client.post("/file/upload/", files={"in_file": (f"bulk{i}.txt", f"bulk {i}".encode())}, headers=owner).json()["file_id"]
+        for i in range(2)
+    ]
+    assert client.post("/file/share/", json={"file_id": file_ids[0], "email": "bulk-b@example.com"}, headers=owner).status_code == 200
+
+    request = {
+        "file_ids": file_ids + ["not-my-file"],
+        "emails": ["bulk-a@example.com", "bulk-b@example.com", "nobody@example.com"]
+    }
+    resp = client.post("/file/share/bulk/", json=request, headers=owner)
+    assert resp.status_code == 200
+    statuses = {(r["file_id"], r["email"]): r["status"] for r in resp.json()["results"]}
+    assert len(statuses) == 9
+    assert statuses[(file_ids[0], "bulk-b@example.com")] == "already_shared"
+    assert statuses[(file_ids[1], "bulk-b@example.com")] == "shared"
+    assert statuses[(file_ids[1], "bulk-a@example.com")] == "shared"
+    assert statuses[(file_ids[0], "nobody@example.com")] == "user_not_found"
+    assert statuses[("not-my-file", "bulk-a@example.com")] == "not_owner"
+
+    shared = client.get("/file/list/", headers=recipient).json()["shared_files"]
+    assert sorted(f["id"] for f in shared) == sorted(file_ids)
+
+    again = client.post("/file/share/bulk/", json=request, headers=owner).json()["results"]
+    assert all(r["status"] != "shared" for r in again)
+
+def test_bulk_share_skips_concurrent_shares(setup_database, monkeypatch):
+    from app import crud
+    from app.models import FileChange, SharedFile, User
+
+    owner = login("race-owner@example.com")
+    login("race-recipient@example.com")
+    file_ids = [
+        client.post("/file/upload/", files={"in_file": (f"race{i}.txt", b"race")}, headers=owner).json()["file_id"]
+        for i in range(2)
+    ]
+    db = TestingSessionLocal()
+    recipient_id = db.query(User.id).filter(User.email == "race-recipient@example.com").scalar()
+
+    # Another request shares the first file after the existing shares were read
+    insert_ignoring_duplicates = crud.insert_ignoring_duplicates
+    def concurrent_share(model, rows, session, returning=()):
+        if model is SharedFile:
+            db.add(SharedFile(file_id=file_ids[0], shared_user_id=recipient_id))
+            db.commit()
+        return insert_ignoring_duplicates(model, rows, session, returning)
+    monkeypatch.setattr(crud, "insert_ignoring_duplicates", concurrent_share)
+
+    request = {"file_ids": file_ids, "emails": ["race-recipient@example.com"]}
+    results = client.post("/file/share/bulk/", json=request, headers=owner).json()["results"]
+    assert [r["status"] for r in results] == ["already_shared", "shared"]
+    logged = db.query(FileChange.file_id).filter(FileChange.user_id == recipient_id, FileChange.action == "share").all()
+    assert [file_id for (file_id,) in logged] == [file_ids[1]]
+    db.close()
+
+def test_tiering_demotes_and_promotes(setup_database, tmp_path, monkeypatch):
+    import os
+    from datetime import datetime, timedelta, UTC
+    from app import tiering as tiering_module
+    from app import volumes as storage_volumes
+    from app.metrics import metrics
+    from app.models import Chunk, File, FileVersion, FileVersionChunk
+    from app.crud import get_file_chunks_on_volume
+    from app.storage import encode_blob
+    from app.volumes import Volume, chunk_path
+
+    monkeypatch.setattr(storage_volumes, "cold_volume", Volume("cold", str(tmp_path / "cold")))
+    monkeypatch.setattr(tiering_module, "TIERING_COMPRESS", True)
+    headers = login("tiering@example.com")
+    content = b"rarely read " * 2000
+    file_id = client.post("/file/upload/", files={"in_file": ("cold.txt", content)}, headers=headers).json()["file_id"]
+
+    def file_chunk(db):
+        return (
+            db.query(Chunk)
+            .join(FileVersionChunk, FileVersionChunk.chunk_id == Chunk.id)
+            .join(FileVersion, FileVersion.id == FileVersionChunk.version_id)
+            .filter(FileVersion.file_id == file_id)
+            .first()
+        )
+
+    db = TestingSessionLocal()
+    assert client.get("/file/download/", params={"file_id": file_id}, headers=headers).content == content
+    assert tiering_module.access_stats.flush(db) >= 1
+    assert db.query(File).filter(File.id == file_id).first().access_count == 1
+
+    tiering = tiering_module.Tiering()
+    assert tiering.demote(db, older_than=datetime.now(UTC) + timedelta(days=1)) >= 1
+    chunk = file_chunk(db)
+    assert (chunk.volume, chunk.compression) == ("cold", "zlib")
+    assert chunk.stored_size < chunk.size
+
+    # Served from the cold volume and queued for promotion
+    assert client.get("/file/download/", params={"file_id": file_id}, headers=headers).content == content
+    assert file_id in tiering_module.tiering._promotions
+    assert any(t["labels"] == {"tier": "cold"} for t in metrics.snapshot()["timers"]["download_seconds"])
+
+    [(chunk_id, cold_location, compression)] = get_file_chunks_on_volume(file_id, "cold", db)
+    assert tiering.promote(db, file_id) == 1
+    # A process promoting the file at the same time loses the race and removes only its own copy
+    racing = tiering_module.Tiering()
+    assert not racing.move_tier(db, Chunk, chunk_id, cold_location, compression, chunk_path(storage_volumes.volumes[0], chunk_id),
+                                "promote", volume="default")
+    db.expire_all()
+    chunk = file_chunk(db)
+    assert (chunk.volume, chunk.compression) == ("default", None)
+    assert client.get("/file/download/", params={"file_id": file_id}, headers=headers).content == content
+
+    # Removing the copies left behind by both moves keeps the promoted blob
+    tiering.unlink_moved_blobs(delay=0)
+    assert client.get("/file/download/", params={"file_id": file_id}, headers=headers).content == content
+
+    # Same for files uploaded before versioning
+    owner_id = db.query(File.owner_user_id).filter(File.id == file_id).scalar()
+    location = os.path.join(storage_volumes.volumes[0].path, "before-versioning.txt")
+    storage_volumes.write_file(location, encode_blob(content))
+    legacy = File(file_name="before-versioning.txt", owner_user_id=owner_id, checksum="0", location=location)
+    db.add(legacy)
+    db.commit()
+    assert tiering.demote(db, older_than=datetime.now(UTC) + timedelta(days=1)) >= 1
+    assert tiering.promote(db, legacy.id) == 1
+    tiering.unlink_moved_blobs(delay=0)
+    assert client.get("/file/download/", params={"file_id": legacy.id}, headers=headers).content == content
+    db.close()
+
+def test_replica_routing(tmp_path, monkeypatch):
+    from app import database
+
+    replica = database.Replica("replica0", f"sqlite:///{tmp_path / 'replica.db'}")
+    broken = database.Replica("broken", f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    monkeypatch.setattr(database, "replicas", [replica, broken])
+
+    def bound_to(db):
+        bind = db.get_bind()
+        db.close()
+        return bind
+
+    database.check_replicas()
+    assert replica.healthy and not broken.healthy
+    assert bound_to(database.open_session("GET", "reader")) is replica.engine
+    assert bound_to(database.open_session("POST", "reader")) is database.engine
+
+    # Reads right after a write with the same token go to the primary
+    database.mark_recent_write("writer")
+    assert bound_to(database.open_session("GET", "writer")) is database.engine
+    monkeypatch.setattr(database, "READ_YOUR_WRITES_SECONDS", 0)
+    assert bound_to(database.open_session("GET", "writer")) is replica.engine
+
+    # An unreachable replica is skipped and the primary serves the read
+    broken.healthy = True
+    replica.healthy = False
+    assert bound_to(database.open_session("GET", "reader")) is database.engine
+    assert not broken.healthy
+
+def test_storage_breakdown(setup_database):
+    headers = login("breakdown@example.com")
+    client.post("/file/upload/", files={"in_file": ("notes.txt", b"12345")}, headers=headers)
+    client.post("/file/upload/", files={"in_file": ("photo.png", b"\x89PNG1234567", "image/png")}, headers=headers)
+    client.post("/file/upload/", files={"in_file": ("more.txt", b"123")}, headers=headers)
+
+    owned = {f["file_name"]: f for f in client.get("/file/list/", headers=headers).json()["owned_files"]}
+    assert (owned["notes.txt"]["size"], owned["notes.txt"]["content_type"]) == (5, "text/plain")
+    assert (owned["photo.png"]["size"], owned["photo.png"]["content_type"]) == (11, "image/png")
+
+    breakdown = client.get("/user/storage/breakdown/", headers=headers).json()
+    by_type = {row["content_type"]: row for row in breakdown["by_type"]}
+    assert (by_type["text/plain"]["files"], by_type["text/plain"]["size"]) == (2, 8)
+    assert by_type["image/png"]["stored_size"] > 11
+    assert breakdown["total"]["size"] == 19
+    assert [(row["files"], row["size"]) for row in breakdown["by_month"]] == [(3, 19)]
+
+def test_blob_cache_coalesces_and_evicts(setup_database, monkeypatch):
+    import os
+    import threading
+    from app.cache import BlobCache, blob_cache
+
+    cache = BlobCache(max_bytes=10, max_file_bytes=6)
+    loads = []
+    release = threading.Event()
+
+    def slow_load():
+        loads.append(1)
+        release.wait(5)
+        return b"abcd"
+
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(cache.get("hot", slow_load))) for _ in range(5)]
+    for reader in readers:
+        reader.start()
+    release.set()
+    for reader in readers:
+        reader.join()
+    assert results == [b"abcd"] * 5 and len(loads) == 1
+
+    cache.get("b", lambda: b"1234")
+    cache.get("hot", lambda: b"never loaded")
+    cache.get("c", lambda: b"5678")  # evicts "b", the least recently used
+    cache.get("too-big", lambda: b"12345678901")
+    cache.get("of-a-big-file", lambda: b"12", cacheable=False)
+    assert cache.stats() == {"bytes": 8, "entries": 2}
+    assert cache.admits(6) and not cache.admits(7) and not cache.admits(None)
+    cache.invalidate(["hot"])
+    assert cache.get("hot", lambda: b"reloaded") == b"reloaded"
+
+    # Downloads share the decrypted chunks until the file is deleted
+    monkeypatch.setattr(blob_cache, "max_bytes", 1024 * 1024)
+    headers = login("cache@example.com")
+    file_id = client.post("/file/upload/", files={"in_file": ("popular.txt", b"everyone wants this")}, headers=headers).json()["file_id"]
+    for _ in range(3):
+        assert client.get("/file/download/", params={"file_id": file_id}, headers=headers).content == b"everyone wants this"
+    assert blob_cache.stats()["entries"] == 1
+
+    # A download larger than the whole cache reads past it and keeps the small file's blob
+    monkeypatch.setattr(blob_cache, "max_file_bytes", 1024 * 1024)
+    monkeypatch.setattr(blob_cache, "max_bytes", 5 * 1024 * 1024)
+    large = os.urandom(12 * 1024 * 1024)
+    large_id = client.post("/file/upload/", files={"in_file": ("large.bin", large)}, headers=headers).json()["file_id"]
+    assert client.get("/file/download/", params={"file_id": large_id}, headers=headers).content == large
+    assert blob_cache.stats() == {"bytes": len(b"everyone wants this"), "entries": 1}
+
+    client.delete("/file/delete/", params={"file_id": file_id}, headers=headers)
+    assert blob_cache.stats()["entries"] == 0
+
+def test_staged_upload_and_recovery(setup_database, tmp_path, monkeypatch):
+    import os
+    import time
+    from datetime import datetime, timedelta, UTC
+    from app import database, ingest
+    from app.models import UploadJob, User
+
+    monkeypatch.setattr(ingest, "INGEST_STAGING_LOCATION", str(tmp_path / "staging"))
+    # Jobs are processed outside requests, with their own sessions
+    monkeypatch.setattr(ingest, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    headers = login("staged@example.com")
+
+    def wait_until_finished(job_id):
+        for _ in range(100):
+            status = client.get("/file/upload/status/", params={"job_id": job_id}, headers=headers).json()
+            if status["status"] in ("done", "failed"):
+                return status
+            time.sleep(0.05)
+        raise AssertionError(f"job {job_id} did not finish")
+
+    resp = client.post("/file/upload/staged/", files={"in_file": ("staged.txt", b"processed later")}, headers=headers)
+    assert resp.status_code == 202
+    status = wait_until_finished(resp.json()["job_id"])
+    assert (status["status"], status["progress"], status["version"]) == ("done", 1.0, 1)
+    download = client.get("/file/download/", params={"file_id": status["file_id"]}, headers=headers)
+    assert download.content == b"processed later"
+    assert os.listdir(tmp_path / "staging") == []
+
+    # A job a crashed process was working on, and a staged file whose job was never recorded
+    db = TestingSessionLocal()
+    user_id = db.query(User.id).filter(User.email == "staged@example.com").scalar()
+    stalled_path = tmp_path / "staging" / "stalled"
+    stalled_path.write_bytes(b"resumed after a crash")
+    stale = datetime.now(UTC) - timedelta(hours=1)
+    db.add(UploadJob(
+        id="6f1c1f52-8a47-4c5e-9d1e-5d1c1d1e1f10", user_id=user_id, file_name="resumed.txt", staged_path=str(stalled_path),
+        size=21, status="processing", processed_bytes=7, updated_at=stale
+    ))
+    db.commit()
+    orphan = tmp_path / "staging" / "orphan"
+    orphan.write_bytes(b"never recorded")
+    os.utime(orphan, (stale.timestamp(), stale.timestamp()))
+
+    ingest.recover_upload_jobs()
+    status = wait_until_finished("6f1c1f52-8a47-4c5e-9d1e-5d1c1d1e1f10")
+    assert status["status"] == "done"
+    assert client.get("/file/download/", params={"file_id": status["file_id"]}, headers=headers).content == b"resumed after a crash"
+    assert not orphan.exists() and not stalled_path.exists()
+    db.close()
+
+def test_upload_job_taken_over_by_recovery(setup_database, tmp_path):
+    from datetime import datetime, timedelta, UTC
+    from app.crud import claim_upload_job, fail_upload_job
+    from app.exceptions import UploadJobTakenOver
+    from app.models import UploadJob, User
+    from app.storage import store_file_version
+
+    login("takeover@example.com")
+    db = TestingSessionLocal()
+    user = db.query(User).filter(User.email == "takeover@example.com").first()
+    job_id = "0b7e2c9a-4f3d-4e8a-9c1b-2d3e4f5a6b7c"
+    db.add(UploadJob(id=job_id, user_id=user.id, file_name="taken.txt", staged_path=str(tmp_path / "staged"), size=5))
+    db.commit()
+    stalled = claim_upload_job(job_id, datetime.now(UTC), db).claim
+    # The first worker stalled long enough for recovery to claim the job again
+    recovered = claim_upload_job(job_id, datetime.now(UTC) + timedelta(minutes=1), db).claim
+    assert recovered != stalled
+
+    with pytest.raises(UploadJobTakenOver):
+        store_file_version(db, user, "taken.txt", BytesIO(b"twice"), upload_job_id=job_id, upload_claim=stalled)
+    assert not fail_upload_job(job_id, "The upload could not be stored", db, stalled)
+    assert store_file_version(db, user, "taken.txt", BytesIO(b"twice"), upload_job_id=job_id, upload_claim=recovered)["version"] == 1
+    db.expire_all()
+    assert db.query(UploadJob.status).filter(UploadJob.id == job_id).scalar() == "done"
+    assert db.query(User.current_storage).filter(User.id == user.id).scalar() == 5
+    db.close()
+
+def test_lifespan_and_readiness(setup_database, tmp_path, monkeypatch):
+    import time
+    from sqlalchemy.exc import OperationalError
+    from app import api, database, leader as leader_module, tiering
+    from app.leader import FileLock, leader
+
+    # Startup warms and checks the test database, the background jobs are only recorded
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(tiering, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(leader, "lock", FileLock(str(tmp_path / "leader.lock")))
+    jobs = []
+    monkeypatch.setattr(leader_module, "start_workers", lambda: jobs.append("started"))
+    monkeypatch.setattr(leader_module, "stop_workers", lambda: jobs.append("stopped"))
+
+    assert client.get("/ready/").status_code == 503
+    with TestClient(app) as started:
+        assert started.get("/ready/").json() == {"status": "ready"}
+        for _ in range(100):
+            if leader.is_leader:
+                break
+            time.sleep(0.05)
+        assert jobs == ["started"]
+        # Other processes wait for the lock
+        assert not FileLock(leader.lock.path).acquire()
+
+        def unavailable():
+            raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+        monkeypatch.setattr(api, "check_primary", unavailable)
+        assert started.get("/ready/").status_code == 503
+    assert not leader.is_leader
+    assert jobs == ["started", "stopped"]
+    assert client.get("/ready/").status_code == 503